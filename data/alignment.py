@@ -68,7 +68,7 @@ class ReadAlnLocation (Autoslots):
 
         for cds in record.cds:
             try:
-                cds_location = Location.from_location_str(cds.location)
+                cds_location = cds.get_location()
             except LoactionParsingException, e:
                 print "ReadAlignment/determine_coding_seqs:", e
                 continue
@@ -103,7 +103,8 @@ class ReadAlnLocation (Autoslots):
                                 RIGHT_OF_ALN - fully right or not first which overlaps
                                 FIRST        - first to overlap
         '''
-        cds_loc = Location.from_location_str(cdss[cds_id].location)
+        # CDS start and end are parsed when the CDS is loaded
+        cds_loc = cdss[cds_id]
 
         if (cds_loc.end < aln_loc.start):
             return "LEFT_OF_ALN"
@@ -116,7 +117,7 @@ class ReadAlnLocation (Autoslots):
         if (cds_id == 0):
             return "FIRST"
 
-        cds_prev_loc = Location.from_location_str(cdss[cds_id - 1].location)
+        cds_prev_loc = cdss[cds_id - 1]
         if (not self.__overlap(cds_prev_loc, aln_loc)):
             return "FIRST"
 
@@ -154,8 +155,7 @@ class ReadAlnLocation (Autoslots):
                 return mid
 
         # Check lo
-        cds_location = Location.from_location_str(cdss[lo].location)
-        if self. __overlap(cds_location, aln_location):
+        if self. __overlap(cdss[lo], aln_location):
             return lo
         else:
             return None
@@ -196,7 +196,7 @@ class ReadAlnLocation (Autoslots):
         # Determine following overlapping CDSs - loop while overlaps
         for i in range(first_ovp_id, len(record.cds)):
             cds = record.cds[i]
-            cds_location = Location.from_location_str(cds.location)
+            cds_location = cds.get_location()
 
             # If this one does not overlap, the others also won't because it's sorted
             if not self.__overlap(cds_location, aln_location):
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from data.read import Read
 from utils.location import Location
 
@@ -13,29 +14,66 @@ class ReadContainer (object):
         """
         self.read_repository = {}
 
-    def load_alignment_data (self, read_alignment_file):
+    def load_alignment_data (self, read_alignment_file, record_prefetcher=None):
         ''' Adds all the reads in the alignment file to the
             read repository.
             This is the first stage of filling the read container.
+            @param record_prefetcher (RecordPrefetcher) if supplied, records
+            referenced by the alignments are fetched in the background
+            while the file is being parsed
         '''
-        aln_file = open(read_alignment_file, 'r')
-        for line in aln_file.readlines():
-            self._add_read_from_str(line)
+        with open(read_alignment_file, 'r') as aln_file:
+            for line in aln_file:
+                read = self._add_read_from_str(line)
+                if record_prefetcher is not None:
+                    record_prefetcher.add(aln.nucleotide_accession
+                                          for aln in read.get_alignments(format=iter))
+
+    def set_taxids (self, data_access, record_source=None):
+        '''
+        Sets tax ID of every read alignment. Tax IDs are resolved by
+        accession.version from the taxon of already fetched records
+        (if record_source is given), then from the accession2taxid index
+        (if data access has one), and only the remaining alignments are
+        resolved by GI.
+        @param record_source (RecordContainer, RecordPrefetcher) provides
+        get_taxids_by_version
+        '''
+        version2taxid = {}
+        has_accession2taxid = getattr(data_access, 'has_accession2taxid', lambda: False)()
+        if record_source is not None or has_accession2taxid:
+            versions = set(self.fetch_all_reads_versions())
+            if record_source is not None:
+                version2taxid = record_source.get_taxids_by_version(versions)
+                versions.difference_update(version2taxid)
+            if versions and has_accession2taxid:
+                version2taxid.update(data_access.get_taxids_by_accession(versions, format=dict))
 
-    def set_taxids (self, data_access):
         gis = set()
         for read in self.fetch_all_reads(format=iter):
             for alignment in read.get_alignments():
-                gis.add(alignment.genome_index)
-                #taxid = data_access.get_taxids([alignment.genome_index], format=list)
-                #if taxid is None or len(taxid) == 0:
-                #    alignment.tax_id = None
-                #else:
-                #    alignment.tax_id = taxid[0]
-        taxids = data_access.get_taxids(list(gis), format=dict)
+                if alignment.nucleotide_accession not in version2taxid:
+                    gis.add(alignment.genome_index)
+        gi2taxid = data_access.get_taxids(list(gis), format=dict) if gis else {}
         for read in self.read_repository.values():
             for alignment in read.get_alignments():
-                alignment.tax_id = taxids.get(alignment.genome_index, None)
+                taxid = version2taxid.get(alignment.nucleotide_accession)
+                if taxid is None:
+                    taxid = gi2taxid.get(alignment.genome_index, None)
+                alignment.tax_id = taxid
+
+    def get_taxids(self):
+        '''
+        Returns all distinct tax IDs of read alignments in this
+        container (alignments with no tax ID are skipped).
+        Can be used to prune the taxonomy tree (TaxTree.prune).
+        '''
+        taxids = set()
+        for read in self.read_repository.values():
+            for alignment in read.get_alignments(format=iter):
+                if alignment.tax_id is not None:
+                    taxids.add(alignment.tax_id)
+        return taxids
 
     def get_protein_ids(self, exclude_host=False):
         protein_ids = set([])
@@ -63,6 +101,45 @@ class ReadContainer (object):
                 read_alignment.determine_coding_seqs_optimal(record)
 
 
+    def populate_cdss_while_fetching (self, record_container, table='cds',
+                                      num_threads=4, max_pending_chunks=None,
+                                      lightweight=False):
+        '''
+        Fetches all the records referenced by read alignments and
+        determines coding sequences for every read alignment, mapping the
+        alignments of each record as soon as that record arrives, while
+        the remaining records are still being fetched.
+        Replaces consecutive record_container.populate and populate_cdss calls.
+        @param record_container (RecordContainer)
+        @param table (str) cds, rrna, mrna or misc_rna, or a list of them
+        @param num_threads (int) number of worker threads fetching records
+        @param max_pending_chunks (int) maximum number of fetched, but not
+        yet mapped chunks of records (see RecordContainer.populate_iter)
+        @param lightweight (bool) fetch only the CDS fields needed for
+        mapping (see RecordContainer.populate)
+        '''
+        version2alignments = defaultdict(list)
+        for read in self.fetch_all_reads(format=iter):
+            for read_alignment in read.get_alignments(format=iter):
+                version2alignments[read_alignment.nucleotide_accession].append(read_alignment)
+
+        fetched_records = record_container.populate_iter(
+                version2alignments.keys(), table, num_threads, max_pending_chunks,
+                lightweight)
+        try:
+            for (version, record) in fetched_records:
+                for read_alignment in version2alignments.pop(version):
+                    read_alignment.determine_coding_seqs_optimal(record)
+        finally:
+            # stops fetching if mapping fails
+            fetched_records.close()
+
+        # records which had already been in the record container
+        for (version, read_alignments) in version2alignments.items():
+            record = record_container.fetch_existing_record(version)
+            for read_alignment in read_alignments:
+                read_alignment.determine_coding_seqs_optimal(record)
+
     def fetch_read (self, read_id):
         if self.read_repository.has_key(read_id):
             return self.read_repository[read_id]
@@ -98,5 +175,6 @@ class ReadContainer (object):
         read = Read.from_read_str(read_str)
         assert (not self.read_repository.has_key(read.id))
         self.read_repository[read.id] = read
+        return read
 
 
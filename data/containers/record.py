@@ -1,6 +1,23 @@
 
 import logging
-from ncbi.db.access import WrongTableError, DbQuery
+import sys
+import threading
+from itertools import imap
+from Queue import Queue, Empty, Full
+from ncbi.db.access import WrongTableError, DbQuery, feature_table_names
+
+def _records_taxids (records, versions):
+    ''' @param records dict(key=version, value=record or None) '''
+    version2taxid = {}
+    for version in versions:
+        record = records.get(version)
+        # mock records have no tax ID
+        if record is None or not hasattr(record, 'get_taxid'):
+            continue
+        taxid = record.get_taxid()
+        if taxid is not None:
+            version2taxid[version] = taxid
+    return version2taxid
 
 class RecordContainer (object):
     ''' Serves as a local Record Repository.
@@ -9,6 +26,9 @@ class RecordContainer (object):
         from the record repository.
     '''
 
+    # number of versions fetched by a single worker thread at once
+    fetch_chunk_size = 1000
+
     def __init__ (self):
         self.record_repository  = {}
         self.num_missing_records = 0
@@ -29,25 +49,147 @@ class RecordContainer (object):
         assert (hasattr(db_query, 'get_record'))
         self.db_query = db_query
 
-    def populate (self, versions, table='cds'):
+    def populate (self, versions, table='cds', num_threads=1, lightweight=False):
         '''
         Populates the record container with all the records
         that have produced significant alignments
 
         :param list of NT (GenBank, EMBL, DDBJ) accession.versions
-        :param table (str) available tables are cds, rrna, mrna, misc_rna
+        :param table (str) available tables are cds, rrna, mrna, misc_rna.
+        A list of tables can be given to fetch records holding the features
+        of all of them at once. Records already present in the container
+        are not fetched again, so all the needed tables have to be given
+        in a single call.
+        :param num_threads (int) number of worker threads fetching records
+        concurrently. Each worker uses its own database session (and
+        connection from the engine pool), while fetched records are
+        merged into the repository by the calling thread only.
+        :param lightweight (bool) fetch only the CDS fields needed for
+        mapping. Descriptive fields have to be fetched with hydrate_cdss
+        before they are used.
         '''
-        if table not in DbQuery.supported_tables:
-            raise WrongTableError(table)
-        for version in versions:
-            self.fetch_record(version)
+        for (version, record) in self.populate_iter(versions, table, num_threads,
+                                                    lightweight=lightweight):
+            pass
+
+    def populate_iter (self, versions, table='cds', num_threads=1, max_pending_chunks=None,
+                       lightweight=False):
+        '''
+        Populates the record container the same way as populate, but
+        yields (version, record) pairs as soon as each record has been
+        stored, so records can be processed while the rest of them are
+        still being fetched. Record is None if it doesn't exist.
+        Versions already present in the container are not yielded.
+
+        :param list of NT (GenBank, EMBL, DDBJ) accession.versions
+        :param table (str or list) see populate
+        :param num_threads (int) number of worker threads fetching records
+        :param max_pending_chunks (int) maximum number of fetched chunks
+        waiting to be consumed. Workers block until the consumer catches
+        up, which keeps memory bounded. Defaults to 2 * num_threads.
+        :param lightweight (bool) see populate
+        '''
+        for name in feature_table_names(table):
+            if name not in DbQuery.supported_tables:
+                raise WrongTableError(name)
+        # versions repeat for every alignment, fetch each one only once
+        versions = set(versions).difference(self.record_repository)
+        if hasattr(self.db_query, 'get_missing_versions'):
+            # known to have no record, skip the database
+            missing_versions = self.db_query.get_missing_versions(versions, table)
+            for version in missing_versions:
+                self._store_record(version, None)
+                yield (version, None)
+            versions.difference_update(missing_versions)
+        if not hasattr(self.db_query, 'get_records'):
+            for version in versions:
+                yield (version, self.fetch_record(version, table))
+            return
+        versions = list(versions)
+        chunks = [versions[i:i + self.fetch_chunk_size]
+                  for i in range(0, len(versions), self.fetch_chunk_size)]
+        if lightweight:
+            fetch_chunk = lambda chunk: (chunk, self.db_query.get_records(
+                                                    chunk, table, lightweight=True))
+        else:
+            fetch_chunk = lambda chunk: (chunk, self.db_query.get_records(chunk, table))
+
+        if num_threads > 1 and len(chunks) > 1:
+            fetched_chunks = self._h_fetch_concurrently(fetch_chunk, chunks,
+                                    min(num_threads, len(chunks)),
+                                    max_pending_chunks or 2 * num_threads)
+        else:
+            fetched_chunks = imap(fetch_chunk, chunks)
+
+        try:
+            for (chunk, records) in fetched_chunks:
+                for version in chunk:
+                    self._store_record(version, records.get(version))
+                    yield (version, self.record_repository[version])
+        finally:
+            # stops the workers if the consumer stops early
+            if hasattr(fetched_chunks, 'close'):
+                fetched_chunks.close()
+
+    def _h_fetch_concurrently (self, fetch_chunk, chunks, num_threads, max_pending_chunks):
+        '''
+        Runs fetch_chunk for every chunk in num_threads worker threads
+        and yields the results in order of completion. At most
+        max_pending_chunks results are buffered.
+        If fetching fails, the exception is re-raised in the calling thread.
+        Workers stop (after the chunk they are fetching) once the
+        generator is closed or garbage collected.
+        '''
+        pending_chunks = Queue()
+        for chunk in chunks:
+            pending_chunks.put(chunk)
+        fetched_chunks = Queue(max_pending_chunks)
+        stopped = threading.Event()
+
+        def worker():
+            while not stopped.is_set():
+                try:
+                    chunk = pending_chunks.get_nowait()
+                except Empty:
+                    return
+                try:
+                    result = (True, fetch_chunk(chunk))
+                except Exception:
+                    result = (False, sys.exc_info())
+                # a full queue is waited on in steps, so that the worker
+                # notices when the consumer has stopped
+                while not stopped.is_set():
+                    try:
+                        fetched_chunks.put(result, timeout=0.1)
+                        break
+                    except Full:
+                        pass
+                if not result[0]:
+                    return
+
+        for i in range(num_threads):
+            thread = threading.Thread(target=worker)
+            # workers blocked on a full queue must not keep the
+            # process alive if the consumer stops early
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for i in range(len(chunks)):
+                (success, result) = fetched_chunks.get()
+                if not success:
+                    raise result[0], result[1], result[2]
+                yield result
+        finally:
+            stopped.set()
 
-    def fetch_record (self, nucleotide_accession):
+    def fetch_record (self, nucleotide_accession, table='cds'):
         '''
         @param nucleotide_accession (str)
+        @param table (str or list) see populate
         @return Record (ncbi/db/[genbank/embl])
         '''
-        self._add_record(nucleotide_accession)
+        self._add_record(nucleotide_accession, table)
         return self.record_repository[nucleotide_accession]
 
     def fetch_existing_record (self, nucleotide_accession):
@@ -57,6 +199,16 @@ class RecordContainer (object):
         '''
         return self.record_repository.get(nucleotide_accession)
 
+    def get_taxids_by_version (self, versions):
+        '''
+        Returns tax IDs of the records stored in the container
+        (see UnityRecord.get_taxid).
+        @param versions iterable of accession.versions
+        @return dict(key=version:str, value=taxid:int), versions with
+        no stored record or no taxon are not contained in the dict
+        '''
+        return _records_taxids(self.record_repository, versions)
+
     def fetch_all_records (self, format=iter):
         '''
         Fetches all loaded records in a specified format
@@ -66,7 +218,7 @@ class RecordContainer (object):
         assert (format in [iter, list, set])
         return format(self.record_repository.values())
 
-    def _add_record (self, record_id):
+    def _add_record (self, record_id, table='cds'):
         ''' Adds the record from database if not already present
 	   If unable to find entry in database, stores None instead.
         '''
@@ -75,11 +227,166 @@ class RecordContainer (object):
         except AttributeError:
             raise AttributeError("RecordContainer has not attribute 'db_query'. Did you forget to envoke set_db_access()?")
         if not self.record_repository.has_key(record_id):
-            record = self.db_query.get_record(record_id)
-            try :
-                getattr(record, 'version')
-                self.record_repository[record_id] = record
-            except AttributeError:
-                self.log.info("No record with ID %s", str(record_id))
-                self.record_repository[record_id] = None
-                self.num_missing_records += 1
+            record = self.db_query.get_record(record_id, table=table)
+            self._store_record(record_id, record)
+
+    def _store_record (self, record_id, record):
+        ''' Stores the fetched record into the record repository.
+            If the record is missing, stores None instead.
+        '''
+        try :
+            getattr(record, 'version')
+            self.record_repository[record_id] = record
+        except AttributeError:
+            self.log.info("No record with ID %s", str(record_id))
+            self.record_repository[record_id] = None
+            self.num_missing_records += 1
+
+
+class RecordPrefetcher (object):
+    ''' Fetches records in the background while the alignment file is
+        still being parsed (see ReadContainer.load_alignment_data).
+        Distinct accession.versions are collected as they are added and
+        fetched in chunks by worker threads. Fetching goes through the
+        wrapped data access, so it also warms its record cache, if any.
+        Prefetcher can be used instead of the data access in
+        RecordContainer.set_db_access; prefetched records are then
+        served from memory.
+    '''
+
+    def __init__ (self, db_query, table='cds', lightweight=False,
+                  num_threads=2, chunk_size=None):
+        '''
+        @param db_query (DataAccess, DbQuery) has to provide get_records
+        @param table (str or list) table(s) records are prefetched from
+        @param lightweight (bool) see DbQuery.get_records
+        @param num_threads (int) number of worker threads
+        @param chunk_size (int) number of versions fetched at once,
+        defaults to RecordContainer.fetch_chunk_size
+        '''
+        self.db_query = db_query
+        self.table = table
+        self.lightweight = lightweight
+        self.chunk_size = chunk_size or RecordContainer.fetch_chunk_size
+        self.log = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._seen = set()
+        self._pending = []
+        self._retained = None
+        # versions which have no record
+        self._missing = set()
+        self._records = {}
+        self._chunks = Queue()
+        self._error = None
+        self._workers = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self._h_worker)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def add (self, versions):
+        ''' Schedules versions for prefetching (duplicates are ignored). '''
+        for version in versions:
+            if version not in self._seen:
+                self._seen.add(version)
+                self._pending.append(version)
+        if len(self._pending) >= self.chunk_size:
+            self._h_flush()
+
+    def retain (self, versions):
+        '''
+        Restricts prefetching to the given versions (e.g. versions still
+        referenced after host filtering). Other versions which haven't
+        been fetched yet are skipped, and already fetched ones are dropped.
+        '''
+        with self._lock:
+            self._retained = set(versions)
+            for version in self._records.keys():
+                if version not in self._retained:
+                    del self._records[version]
+
+    def finish (self):
+        ''' Waits until all the scheduled versions have been fetched. '''
+        self._h_flush()
+        for thread in self._workers:
+            self._chunks.put(None)
+        for thread in self._workers:
+            thread.join()
+        self._workers = []
+        if self._error is not None:
+            (t, v, tb) = self._error
+            self._error = None
+            raise t, v, tb
+
+    def get_record (self, version, table='cds'):
+        return self.get_records([version], table).get(version)
+
+    def get_taxids_by_version (self, versions):
+        '''
+        Returns tax IDs of the prefetched records (waiting for
+        prefetching to finish), see RecordContainer.get_taxids_by_version.
+        '''
+        self.finish()
+        with self._lock:
+            return _records_taxids(self._records, versions)
+
+    def get_missing_versions (self, versions, table='cds'):
+        ''' See DataAccess.get_missing_versions '''
+        if hasattr(self.db_query, 'get_missing_versions'):
+            return self.db_query.get_missing_versions(versions, table)
+        return set()
+
+    def get_records (self, versions, table='cds', lightweight=False):
+        '''
+        Returns prefetched records (waiting for prefetching to finish)
+        and fetches the rest from the wrapped data access.
+        Returned records are released from the prefetcher.
+        See DbQuery.get_records.
+        '''
+        if (feature_table_names(table) != feature_table_names(self.table)
+                or lightweight != self.lightweight):
+            return self.db_query.get_records(versions, table, lightweight)
+        self.finish()
+        records = {}
+        missing_versions = []
+        with self._lock:
+            for version in versions:
+                record = self._records.pop(version, None)
+                if record is not None:
+                    records[version] = record
+                elif version not in self._missing:
+                    missing_versions.append(version)
+        if missing_versions:
+            records.update(self.db_query.get_records(missing_versions, table, lightweight))
+        return records
+
+    def _h_flush (self):
+        if self._pending:
+            self._chunks.put(self._pending)
+            self._pending = []
+
+    def _h_worker (self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            if self._error is not None:
+                continue
+            with self._lock:
+                if self._retained is not None:
+                    chunk = [v for v in chunk if v in self._retained]
+            if not chunk:
+                continue
+            try:
+                records = self.db_query.get_records(chunk, self.table, self.lightweight)
+            except Exception:
+                self.log.error('Record prefetching failed', exc_info=True)
+                self._error = sys.exc_info()
+                continue
+            with self._lock:
+                for version in chunk:
+                    if version not in records:
+                        self._missing.add(version)
+                    elif self._retained is None or version in self._retained:
+                        self._records[version] = records[version]
@@ -1,7 +1,6 @@
 import data.resultdata as resdata
 import filters.readprocessing as rstate
 from ncbi.taxonomy.ranks import ranks as tax_ranks
-from utils.location import Location
 
 def bin_reads (
          reads, 
@@ -166,7 +165,7 @@ def add_cds_to_organism(organism, read, target_alignment):
         cdss = []
         for (cds, intersection) in target_cdss:
             cdss.append(cds)
-        sorted_cdss = sorted(cdss, key = lambda cds: Location.from_location_str(cds.location).length())
+        sorted_cdss = sorted(cdss, key = lambda cds: cds.get_location().length())
         target_cds = sorted_cdss[-1]
 
     if organism.contains_identified_coding_region(target_cds):
@@ -0,0 +1,58 @@
+import argparse
+import logging
+import os
+import sys
+sys.path.append(os.getcwd())
+
+from sqlalchemy.engine import create_engine
+
+from ncbi.db.access import DbQuery, unity_feature_tables
+from ncbi.db.cds_from_file import write_feature
+from ncbi.db.sqlite_import import _h_iter_rows
+from ncbi.db.unity import standard_fields
+
+log = logging.getLogger(__name__)
+
+def export_unity(source_db_url, fasta_path, tables=DbQuery.supported_tables):
+    '''
+    Writes unity feature tables (cds, rrna, mrna, misc_rna) into a CDS
+    fasta file which can be used instead of the unity database
+    (--cds-fasta, see ncbi.db.cds_from_file). Features are written
+    grouped by accession.version, so each record is read with a single
+    read afterwards.
+
+    :param source_db_url (str) SQLAlchemy URL of the unity database
+    (MySQL or an SQLite file built by sqlite_import)
+    :param fasta_path (str) path to the output file
+    :param tables list of feature tables to export
+    '''
+    source = create_engine(source_db_url)
+    tmp_path = fasta_path + '.tmp'
+    with open(tmp_path, 'w') as fasta_file:
+        for table in tables:
+            log.info('Exporting unity table %s', table)
+            feature_table = unity_feature_tables[table]
+            for row in _h_iter_rows(source, feature_table, feature_table.c.version):
+                write_feature(fasta_file, table,
+                              dict((name, row[name]) for name in standard_fields))
+    # rename only a complete file, so that a partial export is never indexed
+    os.rename(tmp_path, fasta_path)
+
+def main():
+    parser = argparse.ArgumentParser(description='''\
+        Exports unity feature tables into a CDS fasta file which
+        can be used instead of the unity database (--cds-fasta).''')
+    parser.add_argument('unity_source',
+        help='Unity database connection string to export from')
+    parser.add_argument('cds_fasta',
+        help='CDS fasta output file')
+    parser.add_argument('--tables', nargs='+', default=DbQuery.supported_tables,
+        choices=DbQuery.supported_tables,
+        help='Feature tables to export')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    export_unity(args.unity_source, args.cds_fasta, args.tables)
+
+if __name__ == '__main__':
+    main()
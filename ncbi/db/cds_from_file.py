@@ -0,0 +1,158 @@
+'''
+Unity feature tables (cds, rrna, mrna, misc_rna) stored in a flat
+FASTA file, used instead of the unity database (--cds-fasta).
+Each feature is a FASTA entry whose header holds the feature table
+name followed by the unity columns (standard_fields order), separated
+by tabs. Empty columns are NULLs. Sequence lines are optional and
+ignored:
+>cds\tid\tdb\tversion\tnucl_gi\ttaxon\tlocation\tprotein_id\tlocus_tag\tproduct\tgene\tprot_gi
+'''
+import logging
+import os
+
+from ncbi.db.access import feature_table_names
+from ncbi.db.ncbitax_from_file import _load_cached
+from ncbi.db.unity import UnityRecord, UnityCDS, standard_fields
+
+log = logging.getLogger(__name__)
+
+supported_tables = ('cds', 'mrna', 'rrna', 'misc_rna')
+
+_integer_fields = set(['id', 'nucl_gi', 'taxon', 'prot_gi'])
+
+def write_feature(out_file, table, attributes, sequence=None):
+    '''
+    Writes a single feature entry into the flat file.
+
+    :param out_file file opened for writing
+    :param table (str) cds, rrna, mrna or misc_rna
+    :param attributes dict of the unity columns (UnityCDS.attributes)
+    :param sequence (str) feature sequence (optional)
+    '''
+    values = [table]
+    for name in standard_fields:
+        value = attributes.get(name)
+        if value is None:
+            values.append('')
+        else:
+            values.append(' '.join(unicode(value).encode('utf-8').split()))
+    out_file.write('>%s\n' % '\t'.join(values))
+    if sequence:
+        for i in range(0, len(sequence), 80):
+            out_file.write(sequence[i:i + 80] + '\n')
+
+def _parse_header(line):
+    ''' :rtype (table, dict of the unity columns) '''
+    values = line[1:].rstrip('\r\n').split('\t')
+    table = values[0]
+    attributes = {}
+    for (name, value) in zip(standard_fields, values[1:]):
+        if not value:
+            value = None
+        elif name in _integer_fields:
+            value = int(value)
+        attributes[name] = value
+    return (table, attributes)
+
+class CdsFileIndex(object):
+    '''
+    Serves records from the feature flat file. Byte ranges of the
+    features of each (table, accession.version) are indexed in a single
+    pass over the file. The index is cached next to the file and reused
+    while the file doesn't change, so a lookup reads only the byte ranges
+    of the requested records.
+    Consecutive features of the same record are stored as a single range,
+    so files grouped by version need a single read per record.
+    '''
+
+    def __init__(self, fasta_path, use_cache=True):
+        '''
+        :param fasta_path path to the feature flat file
+        :param use_cache (boolean) if False, the index is rebuilt and not stored
+        '''
+        if not os.path.isfile(fasta_path):
+            raise ValueError('''Path you supplied to the CDS\
+                 fasta file seems to be invalid.''')
+        self.fasta_path = fasta_path
+        parse = lambda: self._h_build_index(fasta_path)
+        if use_cache:
+            self._index = _load_cached(fasta_path, 'cds index', parse)
+        else:
+            self._index = parse()
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_record(self, version, table='cds'):
+        return self.get_records([version], table).get(version)
+
+    def get_records(self, versions, table='cds', lightweight=False):
+        '''
+        Returns the records associated with the given accession.versions.
+        Byte ranges are read in file order, each with a single read.
+
+        :param versions: list of GenBank/EMBL/DDBJ/RefSeq Accesion.Versions
+        :param table: (str) cds, rrna, mrna or misc_rna, or a list of them
+                  (records then hold the features of all the tables)
+        :param lightweight: (bool) ignored, features are always read whole
+                  (there is no transfer overhead to save)
+        :returns: dict(key=version:str, value=UnityRecord). Versions with
+                  no record in the file are not contained in the dict.
+        '''
+        tables = feature_table_names(table)
+        for name in tables:
+            if name not in supported_tables:
+                raise ValueError('Nonexistent table %s. Only cds, rrna, mrna and misc_rna supported.' % name)
+        ranges = []
+        for version in set(versions):
+            for name in tables:
+                ranges.extend(self._index.get((name, version), ()))
+        ranges.sort()
+
+        records = {}
+        if not ranges:
+            return records
+        # a file object per call, so that records can be fetched concurrently
+        with open(self.fasta_path, 'rb') as fasta_file:
+            for (offset, length) in ranges:
+                fasta_file.seek(offset)
+                for line in fasta_file.read(length).split('\n'):
+                    if not line.startswith('>'):
+                        continue
+                    (feature_table, attributes) = _parse_header(line)
+                    attributes['feature_table'] = feature_table
+                    version = attributes['version']
+                    record = records.get(version)
+                    if record is None:
+                        record = records[version] = UnityRecord(version)
+                    record.add_cds(UnityCDS(attributes))
+
+        for record in records.values():
+            record.cds.sort(key=lambda x: x.location_min)
+        return records
+
+    @staticmethod
+    def _h_build_index(fasta_path):
+        '''
+        :rtype dict(key=(table, version), value=list of (offset, length))
+        '''
+        log.info('Building CDS index for %s', fasta_path)
+        index = {}
+        current_key = None
+        range_start = 0
+        offset = 0
+        with open(fasta_path, 'rb') as fasta_file:
+            for line in fasta_file:
+                if line.startswith('>'):
+                    (table, attributes) = _parse_header(line)
+                    key = (table, attributes['version'])
+                    if key != current_key:
+                        if current_key is not None:
+                            index.setdefault(current_key, []).append(
+                                (range_start, offset - range_start))
+                        current_key = key
+                        range_start = offset
+                offset += len(line)
+        if current_key is not None:
+            index.setdefault(current_key, []).append((range_start, offset - range_start))
+        return index
@@ -1,6 +1,11 @@
+import os
 from utils import enum
 from ncbi.db.ncbitax_from_file import *
-from ncbi.db.access import DbQuery
+from ncbi.db.access import DbQuery, feature_table_names
+from ncbi.db.cds_from_file import CdsFileIndex
+from ncbi.db.record_cache import RecordCache, MissingRecordCache
+from ncbi.db.name_index import NameIndex
+from utils.lrucache import LRUCache
 
 class DataAccess ():
     '''
@@ -27,26 +32,85 @@ class DataAccess ():
         * names
         * nodes
         * ncbitax_db_connection
+        * record_cache (optional)
+        * record_cache_size (optional, in MB)
+        * db_snapshot (optional)
+        * missing_record_cache (optional)
+        * missing_record_ttl (optional, in days)
+        * gi2taxid_cache_size (optional)
+        * accession2taxid (optional, list of nucl_*.accession2taxid dumps)
+        * name_index (optional)
+        * db_stats (optional)
+        * slow_query_threshold (optional, in seconds)
         '''
         self._h_set_load_type(args)
 
+        # DbQuery connects to each database on its first query only, so
+        # databases replaced by files are never connected to
         if self.cds_source_type == DataAccess.load_type.FILE:
-            raise ValueError('Loading CDSs from fasta file currently not supported.')
-
-        self._db_access = DbQuery()
+            self._cds_file_access = CdsFileIndex(self.cds_source)
+            unity_db_url = getattr(args, 'cds_db_connection', None)
+        else:
+            self._cds_file_access = None
+            unity_db_url = self.cds_source
+        if self.ncbitax_source_type == DataAccess.load_type.DATABASE:
+            self._db_access = DbQuery(unity_db_url, self.ncbitax_source)
+        else:
+            self._db_access = DbQuery(unity_db_url, args.ncbitax_db_connection)
+        if getattr(args, 'db_stats', False):
+            slow_query_threshold = getattr(args, 'slow_query_threshold', None)
+            if slow_query_threshold is None:
+                slow_query_threshold = 1.0
+            self._db_access.enable_instrumentation(slow_query_threshold)
+        self._snapshot_tag = getattr(args, 'db_snapshot', None)
+        if self._cds_file_access is None:
+            self._h_open_record_cache(args)
+            self._h_open_missing_record_cache(args)
+        else:
+            # records are read directly from the indexed file
+            self._record_cache = None
+            self._missing_record_cache = None
+        # organism name index, loaded on the first by-name lookup
+        self._name_index_path = getattr(args, 'name_index', None)
+        self._name_index = None
 
         if self.ncbitax_source_type == DataAccess.load_type.FILE:
             self._h_load_ncbitax_data()
 
-        self._gi2taxid_cache = {}
+        cache_size = getattr(args, 'gi2taxid_cache_size', None) or 1000000
+        self._gi2taxid_cache = LRUCache(cache_size)
+
+        accession2taxid_dumps = getattr(args, 'accession2taxid', None) or []
+        if isinstance(accession2taxid_dumps, basestring):
+            accession2taxid_dumps = [accession2taxid_dumps]
+        self._accession2taxid_file_access = [Accession2TaxidIndex.open_or_build(dump)
+                                             for dump in accession2taxid_dumps]
 
     def clear_cache(self):
         '''
         Clears gi2taxid cache used for faster
         data loding since each get_taxid query  may execute
         a MySql query.
+        Cache is size-bounded, so clearing it is not required
+        to keep the memory usage in check.
+        '''
+        self._gi2taxid_cache.clear()
+
+    def get_cache_stats(self):
+        '''
+        Returns gi2taxid cache statistics.
+
+        :rtype dict with size, max_size, hits, misses and evictions
         '''
-        self._gi2taxid_cache = {}
+        return self._gi2taxid_cache.stats()
+
+    def get_query_summary(self):
+        '''
+        Returns summary of database query statistics (latency histograms,
+        row counts, transferred bytes per query type), or None if
+        statistics are not collected (db_stats argument).
+        '''
+        return self._db_access.get_query_summary()
 
     def get_record(self, version, table='cds'):
         '''
@@ -56,7 +120,73 @@ class DataAccess ():
         :returns: UnityRecord - record associated with the given
                   accession.version. None if no record is found
         '''
-        return self._db_access.get_record(version)
+        return self.get_records([version], table).get(version)
+
+    def get_records(self, versions, table='cds', lightweight=False):
+        '''
+        Returns the records associated with the given accession.versions.
+
+        :param versions: list of GenBank/EMBL/DDBJ/RefSeq Accesion.Versions
+        :param table: (str) cds, rrna, mrna or misc_rna, or a list of them
+                  (fetched together, see DbQuery.get_records)
+        :param lightweight: (bool) fetch only the fields needed for mapping
+                  (see DbQuery.get_records and hydrate_cdss)
+        :returns: dict(key=version:str, value=UnityRecord). Versions with
+                  no record are not contained in the dict.
+        '''
+        if self._cds_file_access is not None:
+            return self._cds_file_access.get_records(versions, table, lightweight)
+        # records fetched from several tables are cached separately
+        table_key = '+'.join(feature_table_names(table))
+        if self._missing_record_cache is not None:
+            missing_versions = self._missing_record_cache.get_missing(versions, table_key)
+            versions = [v for v in versions if v not in missing_versions]
+        if self._record_cache is None:
+            records = self._db_access.get_records(versions, table, lightweight)
+            self._h_store_missing(versions, records, table_key)
+            return records
+        # lightweight records are cached separately from the full ones
+        cache_table = table_key + ':lightweight' if lightweight else table_key
+        records = self._record_cache.get_many(versions, cache_table)
+        uncached_versions = [v for v in versions if v not in records]
+        if uncached_versions:
+            fetched_records = self._db_access.get_records(uncached_versions, table, lightweight)
+            self._record_cache.put_many(fetched_records.values(), cache_table)
+            self._h_store_missing(uncached_versions, fetched_records, table_key)
+            records.update(fetched_records)
+        return records
+
+    def get_missing_versions(self, versions, table='cds'):
+        '''
+        Returns the versions known to have no record in the database
+        (recorded in the missing record cache in this or previous runs).
+
+        :param versions: list of GenBank/EMBL/DDBJ/RefSeq Accesion.Versions
+        :param table: (str) cds, rrna, mrna or misc_rna, or a list of them
+        :returns: set of versions
+        '''
+        if self._missing_record_cache is None:
+            return set()
+        return self._missing_record_cache.get_missing(
+                list(versions), '+'.join(feature_table_names(table)))
+
+    def _h_store_missing(self, queried_versions, records, table):
+        if self._missing_record_cache is not None:
+            self._missing_record_cache.put_many(
+                [v for v in queried_versions if v not in records], table)
+
+    def hydrate_cdss(self, cdss, table='cds'):
+        '''
+        Fetches descriptive fields (protein_id, product, gene...) of
+        CDSs loaded with get_records(..., lightweight=True).
+
+        :param cdss: iterable of UnityCDSs
+        :param table: (str) table the CDSs have been fetched from, used
+        for CDSs with no feature_table
+        '''
+        # records read from the CDS file are never lightweight
+        if self._cds_file_access is None:
+            self._db_access.hydrate_cdss(cdss, table)
 
     def get_taxids (self, gis, format=dict):
         '''
@@ -69,18 +199,21 @@ class DataAccess ():
         contain duplicates.
         '''
         requested_gis = {}
-        if self.ncbitax_source == DataAccess.load_type.FILE:
-            requested_gis = dict((gi, self._gi2taxid_file_access.get(gi,-1)) for gi in gis)
+        if self.ncbitax_source_type == DataAccess.load_type.FILE:
+            requested_gis = self._gi2taxid_file_access.get_taxids(gis)
         else:
-            for i in range(len(gis)-1,-1,-1):
-                taxid = self._gi2taxid_cache.get(gis[i], None)
+            uncached_gis = []
+            for gi in set(gis):
+                taxid = self._gi2taxid_cache.get(gi)
                 if taxid is not None:
-                    requested_gis[gis[i]] = taxid
-                    gis.pop(i)
-            if len(gis):
-                requested_gis.update(self._db_access.get_taxids(gis, format=dict))
-            for (gi, taxid) in requested_gis.items():
-                self._gi2taxid_cache[gi] = taxid
+                    requested_gis[gi] = taxid
+                else:
+                    uncached_gis.append(gi)
+            if uncached_gis:
+                fetched_gis = self._db_access.get_taxids(uncached_gis, format=dict)
+                for (gi, taxid) in fetched_gis.items():
+                    self._gi2taxid_cache.put(gi, taxid)
+                requested_gis.update(fetched_gis)
         if format != dict:
             return requested_gis.values()
         else:
@@ -88,24 +221,226 @@ class DataAccess ():
 
 
 
+    def has_accession2taxid (self):
+        ''' True if accession.version to tax ID index has been supplied '''
+        return bool(self._accession2taxid_file_access)
+
+    def get_taxids_by_accession (self, versions, format=dict):
+        '''
+        Fetches taxonomy ID for each of the accession.versions from the
+        accession2taxid indexes (looked up in the order they were supplied).
+
+        :param versions (iterable) GenBank/EMBL/DDBJ/RefSeq accession.versions
+        :param format (object type) list or dict
+        :rtype based on format parameter, returns either list of tax IDs or
+        a dictionary mapping versions to tax IDs. Versions not found in the
+        indexes are not included.
+        '''
+        requested_versions = {}
+        remaining_versions = set(versions)
+        for index in self._accession2taxid_file_access:
+            if not remaining_versions:
+                break
+            found = index.get_taxids(remaining_versions)
+            requested_versions.update(found)
+            remaining_versions.difference_update(found)
+        if format != dict:
+            return requested_versions.values()
+        else:
+            return requested_versions
+
     def get_organism_name (self, taxid, name_class='scientific name'):
+        if taxid is None:
+            return None
+        return self.get_organism_names([taxid], name_class).get(int(taxid))
+
+    def get_organism_names (self, taxids, name_class='scientific name'):
+        r'''
+        Fetches organism names for all the taxonomy IDs.
+        Names are cached process-wide (in FILE mode, the whole
+        names table of the name class is loaded once).
+        Only names of exactly the given class are returned, also when
+        it is a suffix of another class:
+
+        >>> import argparse, os, shutil, tempfile
+        >>> tmp_dir = tempfile.mkdtemp()
+        >>> def dump(name, content):
+        ...     open(os.path.join(tmp_dir, name), 'w').write(content)
+        ...     return os.path.join(tmp_dir, name)
+        >>> args = argparse.Namespace(cds_db_connection=None,
+        ...     ncbitax_db_connection=None,
+        ...     cds_fasta=dump('cds.fa', ''),
+        ...     gi2taxid=dump('gi.dmp', '1\t10090\n'),
+        ...     nodes=dump('nodes.dmp', '10090\t|\t1\t|\tspecies\t|\n'),
+        ...     names=dump('names.dmp',
+        ...         '10090\t|\tMus musculus\t|\t\t|\tscientific name\t|\n'
+        ...         '10090\t|\thouse mouse\t|\t\t|\tgenbank common name\t|\n'
+        ...         '10090\t|\tmouse\t|\t\t|\tcommon name\t|\n'))
+        >>> data_access = DataAccess(args)
+        >>> data_access.get_organism_names([10090], 'common name')
+        {10090: 'mouse'}
+        >>> data_access.get_organism_names([10090], 'genbank common name')
+        {10090: 'house mouse'}
+        >>> shutil.rmtree(tmp_dir)
+
+        :param taxids (iterable) taxonomy IDs
+        :param name_class (str) scientific name, common name, genbank common
+        name, synonym...
+        :rtype dict(key=taxid:int, value=name:str). Tax IDs with no name
+        of the given class are not contained in the dict.
+        '''
         if self.ncbitax_source_type == DataAccess.load_type.FILE:
-            return self._taxid2name_file_access.get(taxid, None)
+            if name_class == 'scientific name':
+                taxid2name = self._taxid2name_file_access
+            else:
+                taxid2name = loadNcbiNames(self.ncbitax_source['names'], name_class)
+            return self._h_select_taxids(taxids, taxid2name)
         else:
-            return self._db_access.get_organism_name(taxid, name_class)
+            return self._db_access.get_organism_names(taxids, name_class)
 
     def get_organism_rank (self, query, by_name=False):
+        '''
+        Fetches organism rank. Query can be done using organism name
+        (scientific name) or organism tax ID.
+        '''
+        if by_name:
+            taxid = self.get_organism_taxid(query)
+        else:
+            taxid = query
+        if not taxid:
+            return None
+        return self.get_organism_ranks([taxid]).get(int(taxid))
+
+    def get_organism_ranks (self, taxids):
+        '''
+        Fetches organism ranks for all the taxonomy IDs.
+        Ranks are cached process-wide.
+
+        :param taxids (iterable) taxonomy IDs
+        :rtype dict(key=taxid:int, value=rank:str). Unknown tax IDs
+        are not contained in the dict.
+        '''
         if self.ncbitax_source_type == DataAccess.load_type.FILE:
-            return self._taxid2rank_file_access.get(taxid, None)
+            return self._h_select_taxids(taxids, self._taxid2rank_file_access)
         else:
-            return self._db_access.get_organism_rank(query, by_name)
+            return self._db_access.get_organism_ranks(taxids)
+
+    def get_organism_taxid (self, organism_name, name_class='scientific name',
+                            case_sensitive=True):
+        '''
+        Fetches taxonomy ID of the organism with the given name.
+
+        :rtype int or None if no such organism exists
+        '''
+        return self.get_organism_taxids([organism_name], name_class,
+                                        case_sensitive).get(organism_name)
+
+    def get_organism_taxids (self, organism_names, name_class='scientific name',
+                             case_sensitive=True):
+        '''
+        Fetches taxonomy IDs of the organisms with the given names.
+        Names are looked up in the local name index (see NameIndex) in
+        FILE mode, and in DATABASE mode if the name_index argument has
+        been supplied. Otherwise, names are queried from the database in
+        chunks (case sensitivity then depends on the database collation).
 
+        :param organism_names iterable of organism names
+        :param name_class (str) scientific name, synonym, common name...
+        :param case_sensitive (boolean)
+        :rtype dict(key=name:str, value=taxid:int), unknown names are not
+        contained in the dict
+        '''
+        name_index = self._h_get_name_index(name_class)
+        if name_index is not None:
+            return name_index.get_taxids(organism_names, name_class, case_sensitive)
+        return self._db_access.get_organism_taxids(organism_names, name_class)
+
+    def get_name_index (self):
+        '''
+        Returns the organism name index over scientific names and synonyms.
+        In FILE mode, it is built from the names dump (and cached next to
+        it). In DATABASE mode, it is loaded from the name_index file, or
+        built from the database and stored into that file.
+        '''
+        if self._name_index is None:
+            if self.ncbitax_source_type == DataAccess.load_type.FILE:
+                self._name_index = NameIndex.from_names_dump(self.ncbitax_source['names'])
+            elif self._name_index_path and os.path.isfile(self._name_index_path):
+                self._name_index = NameIndex.load(self._name_index_path)
+            else:
+                self._name_index = NameIndex.from_db(self._db_access)
+                if self._name_index_path:
+                    self._name_index.save(self._name_index_path)
+        return self._name_index
+
+    def _h_get_name_index(self, name_class):
+        ''' Returns name index containing the name class or None
+            if names should be queried from the database.
+        '''
+        if self.ncbitax_source_type == DataAccess.load_type.FILE:
+            if name_class not in NameIndex.default_name_classes:
+                return NameIndex.from_names_dump(self.ncbitax_source['names'],
+                                                 (name_class,))
+        elif not self._name_index_path:
+            return None
+        name_index = self.get_name_index()
+        if name_class not in name_index.name_classes:
+            return None
+        return name_index
+
+    def _h_select_taxids(self, taxids, taxid2value):
+        result = {}
+        for taxid in taxids:
+            value = taxid2value.get(int(taxid))
+            if value is not None:
+                result[int(taxid)] = value
+        return result
+
+
+    def _h_open_record_cache(self, args):
+        '''
+        Opens the persistent record cache if its location has been
+        supplied (record_cache argument). Cache is tagged with the
+        database snapshot tag (db_snapshot argument, or determined
+        from the database if not supplied).
+        '''
+        self._record_cache = None
+        cache_path = getattr(args, 'record_cache', None)
+        if not cache_path:
+            return
+        cache_size = getattr(args, 'record_cache_size', None) or 1024
+        self._record_cache = RecordCache(cache_path, self._h_get_snapshot_tag(),
+                                         cache_size * 1024 * 1024)
+
+    def _h_open_missing_record_cache(self, args):
+        '''
+        Opens the persistent cache of versions with no record in the
+        database if its location has been supplied (missing_record_cache
+        argument). Entries expire after missing_record_ttl days.
+        '''
+        self._missing_record_cache = None
+        cache_path = getattr(args, 'missing_record_cache', None)
+        if not cache_path:
+            return
+        ttl = getattr(args, 'missing_record_ttl', None)
+        if ttl is None:
+            ttl = 7
+        self._missing_record_cache = MissingRecordCache(
+                cache_path, self._h_get_snapshot_tag(), ttl * 24 * 3600)
+
+    def _h_get_snapshot_tag(self):
+        ''' Returns db_snapshot argument, or determines the snapshot
+            tag from the database (only once).
+        '''
+        if self._snapshot_tag is None:
+            self._snapshot_tag = self._db_access.get_snapshot_tag()
+        return self._snapshot_tag
 
     def _h_load_ncbitax_data(self):
         '''
         Loads taxonomy data from NCBI taxonomy dump files.
         After invoking this method, you can query three dictionaries:
-        * gi2taxid (by GI)
+        * gi2taxid (by GI, memory-mapped Gi2TaxidIndex)
         * taxid2name (by taxid)
         * taxid2rank (by taxid)
         '''
@@ -113,7 +448,7 @@ class DataAccess ():
         nodes_fpath = self.ncbitax_source['nodes']
         names_fpath = self.ncbitax_source['names']
 
-        self._gi2taxid_file_access = loadGi2Taxid(gi2taxid_fpath)
+        self._gi2taxid_file_access = Gi2TaxidIndex.open_or_build(gi2taxid_fpath)
         self._taxid2name_file_access = loadNcbiNames(names_fpath)
         self._taxid2rank_file_access = loadNcbiRanks(nodes_fpath)
 
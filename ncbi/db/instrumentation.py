@@ -0,0 +1,97 @@
+import logging
+import threading
+from bisect import bisect_left
+
+slow_query_log = logging.getLogger('ncbi.db.slow_queries')
+
+# upper bounds (in milliseconds) of the latency histogram buckets
+latency_buckets_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+class QueryTypeStats(object):
+    '''
+    Accumulated statistics for a single type of query.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.
+        self.max_time = 0.
+        self.rows = 0
+        self.bytes = 0
+        # last bucket holds queries slower than the largest bound
+        self.histogram = [0] * (len(latency_buckets_ms) + 1)
+
+    def add(self, duration, rows, nbytes):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.rows += rows
+        self.bytes += nbytes
+        self.histogram[bisect_left(latency_buckets_ms, duration * 1000.)] += 1
+
+class QueryStats(object):
+    '''
+    Collects per query type latency histograms, row counts and
+    transferred bytes for database queries. Queries slower than
+    slow_query_threshold are logged to the ncbi.db.slow_queries logger.
+    Can be shared between threads.
+    '''
+
+    def __init__(self, slow_query_threshold=1.0):
+        '''
+        :param slow_query_threshold (float) in seconds
+        '''
+        self.slow_query_threshold = slow_query_threshold
+        self.query_types = {}
+        self._lock = threading.Lock()
+
+    def record(self, query_type, duration, rows, nbytes, description=''):
+        '''
+        :param query_type (str) e.g. get_records, get_taxids
+        :param duration (float) query duration in seconds
+        :param rows (int) number of fetched rows
+        :param nbytes (int) (approximate) number of fetched bytes
+        :param description (str) query details logged for slow queries
+        '''
+        with self._lock:
+            stats = self.query_types.get(query_type)
+            if stats is None:
+                stats = self.query_types[query_type] = QueryTypeStats()
+            stats.add(duration, rows, nbytes)
+        if duration >= self.slow_query_threshold:
+            slow_query_log.warning('Slow query %s (%.3f s, %d rows, %d bytes) %s',
+                                   query_type, duration, rows, nbytes, description)
+
+    def summary(self):
+        '''
+        :rtype str human readable summary of all recorded queries
+        '''
+        lines = ['%-20s %8s %10s %10s %10s %12s %14s' % ('query', 'count',
+                 'total [s]', 'avg [ms]', 'max [ms]', 'rows', 'bytes')]
+        with self._lock:
+            for (query_type, stats) in sorted(self.query_types.items()):
+                lines.append('%-20s %8d %10.3f %10.2f %10.2f %12d %14d' % (
+                             query_type, stats.count, stats.total_time,
+                             stats.total_time / stats.count * 1000.,
+                             stats.max_time * 1000., stats.rows, stats.bytes))
+                bounds = ['<=%dms' % b for b in latency_buckets_ms] + ['>%dms' % latency_buckets_ms[-1]]
+                lines.append('    ' + ' '.join('%s:%d' % (bound, count)
+                             for (bound, count) in zip(bounds, stats.histogram) if count))
+        return '\n'.join(lines)
+
+def row_size(row):
+    '''
+    Approximates the number of bytes transferred for a result row
+    (unicode values are measured in UTF-8).
+
+    >>> row_size((1, 'AB000001.1', u'\\u03b2-lactamase', None))
+    23
+    '''
+    return sum(_value_size(value) for value in row if value is not None)
+
+def _value_size(value):
+    if isinstance(value, unicode):
+        return len(value.encode('utf-8'))
+    if isinstance(value, str):
+        return len(value)
+    return len(str(value))
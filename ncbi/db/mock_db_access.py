@@ -1,9 +1,17 @@
+import logging
+import os
+
+from ncbi.db.unity import UnityCDS
 from utils.location import Location
 
+log = logging.getLogger(__name__)
+
 class MockRecord(object):
     ''' Attributes:
         accession:  nucleotide accession
-        cdss:       list of coding sequences in the record
+        cds:        list of coding sequences in the record (UnityCDS),
+                    the same interface as UnityRecord.cds
+        cdss:       same as cds
         sources:    list of source elemtns in the record
         gi:         genome index
         name:       same as accession? 
@@ -12,55 +20,51 @@ class MockRecord(object):
     def __init__(self, accession, gi, seq_len):
         self.accession = accession
         self.name = accession
+        self.version = accession
         self.gi = gi
         self.seq_len = seq_len
-        self.cdss = [MockCds(self.accession, "1..%d" % seq_len)]
+        self.cds = [UnityCDS({'version': accession,
+                              'location': "1..%d" % seq_len})]
+        self.cdss = self.cds
     
     def find_cds(self, location, complement=False, tolerance=0):
         results = []
-        for cds in self.cdss:
-            if cds.matches(location, complement, tolerance):
+        for cds in self.cds:
+            l1 = Location.from_location_str(cds.location, tolerance)
+            if l1.intersects(Location.from_location(location, complement)):
                 results.append(cds)
         return results
-    
-class MockCds(object):
-    ''' db_xref:    GI:genome_index (string)
-        gene:       gene name
-        id:         database id
-        location:   location string (can be parsed with Location.from_location_str)
-        locus_tag:  locus tag
-        product:    protein product
-        record:     record object (which contains this cds)
-        record_id:  record id
-        additional_db_xrefs:    additional db_xref identifiers (list of objects)
-    '''
-
-    def __init__ (self, accession, location):
-        self.location = location
-        self.record_id = accession
-        self.product = None
-        self.locus_tag = None
-        self.gene = None
-        self.db_xref = None
-    
-
-    def matches(self, location, complement, tolerance):
-        l1 = Location.from_location_str(self.location, tolerance)
-        return l1.intersects(Location.from_location(location, complement))
-
-    def __hash__ (self):
-        return hash ((self.record_id, self.location))
-
-    def __eq__ (self, other):
-        if (other == None): return False
-        return (self.record_id, self.location) == (other.record_id, other.location)
-
-    def __str__(self):
-        return "Cds (record_id:" + str(self.record_id) + ", location:" + str(self.location) + ")"
-
 
 
 class MockDbQuery (object):
+    r'''
+    Serves mock records of the sequences in a FASTA file. Accession,
+    GI and sequence length of every sequence are stored in an index
+    file (cds_fname.fai), built on the first use and rebuilt when the
+    FASTA file changes. Records are created lazily, when they are
+    first requested. Each record holds a single CDS spanning the
+    whole sequence, so reads map to the records they are aligned to.
+
+    >>> import os, tempfile
+    >>> from data.containers.read import ReadContainer
+    >>> from data.containers.record import RecordContainer
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> fasta_fname = os.path.join(tmp_dir, 'ref.fa')
+    >>> aln_fname = os.path.join(tmp_dir, 'alns.txt')
+    >>> with open(fasta_fname, 'w') as f:
+    ...     f.write('>gi|11|emb|AB000001.1|\n' + 'A' * 300 + '\n')
+    >>> with open(aln_fname, 'w') as f:
+    ...     f.write('@r0,1;AB000001.1,gb,11,50.0,101,150,+;\n')
+    >>> record_container = RecordContainer()
+    >>> record_container.set_db_access(MockDbQuery(fasta_fname))
+    >>> read_container = ReadContainer()
+    >>> read_container.load_alignment_data(aln_fname)
+    >>> record_container.populate(read_container.fetch_all_reads_versions())
+    >>> read_container.populate_cdss(record_container)
+    >>> aln = read_container.fetch_read('r0').get_alignments()[0]
+    >>> [cds.location for (cds, location) in aln.aligned_cdss]
+    ['1..300']
+    '''
 
     def __init__ (self, cds_fname):
         '''
@@ -68,24 +72,53 @@ class MockDbQuery (object):
         from which mock database access creates mock records
         which cdss that match the whole record.
         '''
+        self.cds_fname = cds_fname
+        index_fname = cds_fname + '.fai'
+        if not (os.path.isfile(index_fname) and
+                os.path.getmtime(index_fname) >= os.path.getmtime(cds_fname)):
+            log.info('Building FASTA index for %s', cds_fname)
+            self._h_build_index(cds_fname, index_fname)
+        # key=accession without version, value=(accession, gi, seq_len)
+        self._index = {}
+        with open(index_fname, 'r') as index_file:
+            for line in index_file:
+                fields = line.rstrip('\n').split('\t')
+                # indexes of older versions hold the header offset too
+                (accession, gi, seq_len) = (fields[0], fields[1], fields[-1])
+                self._index[accession.split('.')[0]] = (accession, gi, int(seq_len))
         self.records = {}
-        cds_fhandle = open (cds_fname, 'r')
-        seq_len = 0
-        accession = ''
-        record_data = {}
-        for line in cds_fhandle.readlines():
-            line = line.strip()
-            if line.startswith('>'):
-                (gi,gi_num,db_source,accession) = line[1:-1].split('|')
-            elif not line:
-                record = MockRecord (accession, gi, seq_len)
-                self.records[accession.split('.')[0]] = record
-                seq_len = 0
-            else:
-                seq_len += len(line)
-
-        cds_fhandle.close()
 
-    def get_record (self, accession, db_source='tst'):
+    def get_record (self, accession, db_source='tst', table='cds'):
+        ''' Mock records contain a single CDS regardless of the table '''
         name = accession.split('.')[0]
-        return self.records[name]
\ No newline at end of file
+        record = self.records.get(name)
+        if record is None:
+            (accession, gi, seq_len) = self._index[name]
+            record = self.records[name] = MockRecord(accession, gi, seq_len)
+        return record
+
+    @staticmethod
+    def _h_build_index (cds_fname, index_fname):
+        '''
+        Writes accession, GI and sequence length (tab-separated) of every sequence in the FASTA file into the
+        index file. Headers have the following format:
+        >gi|gi_num|db_source|accession|
+        '''
+        tmp_fname = index_fname + '.tmp'
+        with open(cds_fname, 'rb') as cds_fhandle:
+            with open(tmp_fname, 'w') as index_file:
+                header = None
+                seq_len = 0
+                offset = 0
+                for line in cds_fhandle:
+                    if line.startswith('>'):
+                        if header is not None:
+                            index_file.write('%s\t%s\t%d\n' % (header + (seq_len,)))
+                        (gi, gi_num, db_source, accession) = line.strip()[1:-1].split('|')
+                        header = (accession, gi)
+                        seq_len = 0
+                    else:
+                        seq_len += len(line.strip())
+                if header is not None:
+                    index_file.write('%s\t%s\t%d\n' % (header + (seq_len,)))
+        os.rename(tmp_fname, index_fname)
@@ -0,0 +1,131 @@
+import cPickle
+import logging
+import os
+
+from ncbi.db.ncbitax_from_file import _dmp_delimiter, _load_cached
+
+log = logging.getLogger(__name__)
+
+class NameIndex(object):
+    '''
+    In-memory organism name to tax ID index supporting exact and
+    case-insensitive lookups, built from NCBI names dump or from the
+    ncbi_names table of the ncbitax database.
+    Names are kept separately for each name class. If a name belongs
+    to several tax IDs (homonyms), the first one loaded is used.
+    '''
+
+    default_name_classes = ('scientific name', 'synonym')
+
+    def __init__(self, name_classes=default_name_classes):
+        '''
+        :param name_classes iterable of name classes to index, when no name
+        class is given, lookups try them in this order
+        '''
+        self.name_classes = tuple(name_classes)
+        self._exact = dict((name_class, {}) for name_class in self.name_classes)
+        self._folded = dict((name_class, {}) for name_class in self.name_classes)
+
+    def add(self, taxid, name, name_class):
+        ''' Adds a name to the index (names of other classes are ignored). '''
+        exact = self._exact.get(name_class)
+        if exact is None:
+            return
+        exact.setdefault(name, taxid)
+        self._folded[name_class].setdefault(name.lower(), taxid)
+
+    def get_taxid(self, name, name_class=None, case_sensitive=True):
+        '''
+        :param name (str) organism name
+        :param name_class (str) name class to search, all indexed
+        classes (in name_classes order) if None
+        :param case_sensitive (boolean)
+        :rtype int or None if the name is not indexed
+        '''
+        if name_class is None:
+            name_classes = self.name_classes
+        else:
+            name_classes = (name_class,)
+        if case_sensitive:
+            names = self._exact
+        else:
+            names = self._folded
+            name = name.lower()
+        for name_class in name_classes:
+            taxid = names[name_class].get(name)
+            if taxid is not None:
+                return taxid
+        return None
+
+    def get_taxids(self, names, name_class=None, case_sensitive=True):
+        '''
+        Looks up a batch of names (see get_taxid).
+
+        :rtype dict(key=name:str, value=taxid:int), names not present
+        in the index are not contained in the dict
+        '''
+        name2taxid = {}
+        for name in names:
+            taxid = self.get_taxid(name, name_class, case_sensitive)
+            if taxid is not None:
+                name2taxid[name] = taxid
+        return name2taxid
+
+    def __len__(self):
+        return sum(len(names) for names in self._exact.values())
+
+    def save(self, index_path):
+        ''' Stores the index into a file (see load). '''
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            cPickle.dump(self, index_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        with open(index_path, 'rb') as index_file:
+            return cPickle.load(index_file)
+
+    @classmethod
+    def from_names_dump(cls, names_dump, name_classes=default_name_classes,
+                        use_cache=True):
+        '''
+        Builds the index from NCBI names taxonomy dump. Each line of
+        the dump has the following format:
+        tax_id\t|\tname_txt\t|\tunique name\t|\tname class\t|
+
+        :param names_dump path to names dump file
+        :param name_classes iterable of name classes to index
+        :param use_cache (boolean) if True, the index is cached next to
+        the dump file and reused while the dump doesn't change
+        '''
+        if not os.path.isfile(names_dump):
+            raise ValueError('''Path you supplied to the names\
+                 dump file seems to be invalid.''')
+
+        def parse():
+            index = cls(name_classes)
+            with open(names_dump, 'r') as names_file:
+                for line in names_file:
+                    (taxid, name, unique_name, name_class) = line.split(_dmp_delimiter, 3)
+                    index.add(int(taxid), name, name_class.rstrip('\t|\n'))
+            return index
+
+        if not use_cache:
+            return parse()
+        return _load_cached(names_dump, 'name index %s' % '_'.join(name_classes), parse)
+
+    @classmethod
+    def from_db(cls, db_query, name_classes=default_name_classes):
+        '''
+        Builds the index from the ncbi_names table (all rows of the name
+        classes are read once).
+
+        :param db_query (DbQuery)
+        :param name_classes iterable of name classes to index
+        '''
+        index = cls(name_classes)
+        for (taxid, name, name_class) in db_query.iter_organism_names(name_classes):
+            index.add(taxid, name, name_class)
+        log.info('Loaded %d organism names from the database', len(index))
+        return index
@@ -1,4 +1,17 @@
 import os
+import sys
+import cPickle
+import heapq
+import logging
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+log = logging.getLogger(__name__)
+
+# NCBI taxonomy dump field delimiter
+_dmp_delimiter = '\t|\t'
 
 def loadGi2Taxid(gi2taxid_dump):
     '''
@@ -33,24 +46,504 @@ def loadGi2Taxid(gi2taxid_dump):
 
     return gi2taxid
 
-def loadNcbiNames(names_dump):
+def buildGi2TaxidIndex(gi2taxid_dump, index_prefix=None, run_size=5000000):
+    '''
+    Converts gi_taxid_[nucl/prot] dump file into two on-disk arrays
+    of the same length, sorted by GI: index_prefix.gi.idx holding GIs
+    and index_prefix.taxid.idx holding corresponding tax IDs.
+    Each value is stored as a little-endian unsigned 32-bit integer.
+    Dumps don't fit into memory, so sorted runs of run_size lines are
+    written to temporary files first and then merged (the same way as
+    in buildAccession2TaxidIndex).
+    The index is built once and then memory-mapped by Gi2TaxidIndex.
+
+    :param gi2taxid_dump path to gi_taxid_[nucl/prot] file.
+    :param index_prefix path prefix of the index files (defaults to
+    the dump path)
+    :param run_size (int) number of lines sorted in memory at once
+    :rtype index_prefix (str)
+    '''
+    if not os.path.isfile(gi2taxid_dump):
+        raise ValueError('''Path you supplied to the gi2taxid\
+             dump file seems to be invalid.''')
+    if index_prefix is None:
+        index_prefix = gi2taxid_dump
+
+    run_paths = []
+    try:
+        with open(gi2taxid_dump, 'r') as gi2taxid_file:
+            run = []
+            for line in gi2taxid_file:
+                try:
+                    (gi, taxid) = line.split()
+                except ValueError:
+                    raise ValueError('''Cannot unpack splitted string into\
+                        two values (gi, taxid) for line %s of input file.'''
+                        % line)
+                run.append((int(gi), int(taxid)))
+                if len(run) == run_size:
+                    run_paths.append(_write_sorted_run(run, index_prefix,
+                                                       len(run_paths), _gi_run_line))
+                    run = []
+            if run or not run_paths:
+                run_paths.append(_write_sorted_run(run, index_prefix,
+                                                   len(run_paths), _gi_run_line))
+            del run
+
+        runs = [open(path, 'rb') for path in run_paths]
+        try:
+            tmp_gis = index_prefix + '.gi.idx.tmp'
+            tmp_taxids = index_prefix + '.taxid.idx.tmp'
+            with open(tmp_gis, 'wb') as gis_file:
+                with open(tmp_taxids, 'wb') as taxids_file:
+                    gis = array('I')
+                    taxids = array('I')
+                    for line in heapq.merge(*runs):
+                        (gi, taxid) = line.split('\t')
+                        gis.append(int(gi))
+                        taxids.append(int(taxid))
+                        if len(gis) == 65536:
+                            _write_uints(gis_file, gis)
+                            _write_uints(taxids_file, taxids)
+                            gis = array('I')
+                            taxids = array('I')
+                    _write_uints(gis_file, gis)
+                    _write_uints(taxids_file, taxids)
+        finally:
+            for run in runs:
+                run.close()
+        # rename only complete files so that a partially written
+        # index is never picked up
+        os.rename(tmp_taxids, index_prefix + '.taxid.idx')
+        os.rename(tmp_gis, index_prefix + '.gi.idx')
+    finally:
+        for path in run_paths:
+            os.remove(path)
+    return index_prefix
+
+# GIs are zero-padded, so that runs are merged in numeric order
+_gi_run_line = '%010d\t%d\n'
+
+class _MappedUIntArray(object):
+    '''
+    Read-only sequence of little-endian unsigned 32-bit integers
+    stored in a memory-mapped file.
+    '''
+    _item = struct.Struct('<I')
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._len = os.path.getsize(path) // self._item.size
+        if self._len:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = ''
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        return self._item.unpack_from(self._map, i * self._item.size)[0]
+
+    def slice(self, start, stop):
+        ''' Copies values [start:stop] into an in-memory array. '''
+        values = array('I')
+        values.fromstring(self._map[start * self._item.size:stop * self._item.size])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    def close(self):
+        if self._len:
+            self._map.close()
+        self._file.close()
+
+class _FixedWidthKeys(object):
+    '''
+    Read-only sequence of keys of the same width stored in a single
+    string, which takes a fraction of the memory of a list of strings.
+    Sorted keys can be searched with bisect.
+    '''
+
+    def __init__(self, data, width):
+        self._data = data
+        self._width = width
+        self._len = len(data) // width if width else 0
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        offset = i * self._width
+        return self._data[offset:offset + self._width]
+
+class Gi2TaxidIndex(object):
+    '''
+    GI to tax ID mapping backed by the memory-mapped index built by
+    buildGi2TaxidIndex. Only the pages touched by lookups are loaded,
+    and the pages are shared between all processes using the index.
+    First GI of each block of block_size GIs is kept in memory, so a
+    lookup reads a single block from the mapped file.
+    '''
+    block_size = 1024
+
+    def __init__(self, index_prefix):
+        self._gis = _MappedUIntArray(index_prefix + '.gi.idx')
+        self._taxids = _MappedUIntArray(index_prefix + '.taxid.idx')
+        assert (len(self._gis) == len(self._taxids))
+        self._block_heads = array('I', (self._gis[i] for i in
+                                  xrange(0, len(self._gis), self.block_size)))
+
+    @classmethod
+    def open_or_build(cls, gi2taxid_dump):
+        '''
+        Opens the index built from the dump file, building it first
+        if it doesn't exist or if the dump is newer than the index.
+        '''
+        gi_index = gi2taxid_dump + '.gi.idx'
+        taxid_index = gi2taxid_dump + '.taxid.idx'
+        dump_mtime = os.path.getmtime(gi2taxid_dump)
+        if not (os.path.isfile(gi_index) and os.path.isfile(taxid_index)
+                and os.path.getmtime(gi_index) >= dump_mtime
+                and os.path.getmtime(taxid_index) >= dump_mtime):
+            log.info('Building gi2taxid index for %s', gi2taxid_dump)
+            buildGi2TaxidIndex(gi2taxid_dump)
+        return cls(gi2taxid_dump)
+
+    def __len__(self):
+        return len(self._gis)
+
+    def get(self, gi, default=None):
+        return self.get_taxids([gi]).get(gi, default)
+
+    def get_taxids(self, gis):
+        '''
+        Looks up a whole batch of GIs at once. GIs are searched in
+        sorted order, so GIs falling into the same block share
+        a single read of that block.
+
+        :param gis iterable of GIs (int)
+        :rtype dict(key=gi:int, value=taxid:int), GIs not present in
+        the index are not contained in the dict
+        '''
+        gi2taxid = {}
+        block_heads = self._block_heads
+        current_block = None
+        for gi in sorted(set(gis)):
+            block = bisect_right(block_heads, gi) - 1
+            if block < 0:
+                continue
+            if block != current_block:
+                current_block = block
+                start = block * self.block_size
+                block_gis = self._gis.slice(start, start + self.block_size)
+            i = bisect_left(block_gis, gi)
+            if i < len(block_gis) and block_gis[i] == gi:
+                gi2taxid[gi] = self._taxids[start + i]
+        return gi2taxid
+
+    def close(self):
+        self._gis.close()
+        self._taxids.close()
+
+def buildAccession2TaxidIndex(accession2taxid_dump, index_prefix=None,
+                              run_size=5000000):
+    '''
+    Converts nucl_*.accession2taxid dump file into an on-disk index
+    sorted by accession.version:
+    * index_prefix.acc.idx - 4-byte little-endian key width W followed
+      by accession.versions, each padded with zero bytes to W bytes
+    * index_prefix.acc_taxid.idx - corresponding tax IDs as
+      little-endian unsigned 32-bit integers
+    Dumps don't fit into memory, so sorted runs of run_size lines are
+    written to temporary files first and then merged.
+    The index is built once and then memory-mapped by Accession2TaxidIndex.
+
+    :param accession2taxid_dump path to nucl_*.accession2taxid file
+    (tab-separated accession, accession.version, taxid, gi with a header line)
+    :param index_prefix path prefix of the index files (defaults to
+    the dump path)
+    :param run_size (int) number of lines sorted in memory at once
+    :rtype index_prefix (str)
     '''
+    if not os.path.isfile(accession2taxid_dump):
+        raise ValueError('''Path you supplied to the accession2taxid\
+             dump file seems to be invalid.''')
+    if index_prefix is None:
+        index_prefix = accession2taxid_dump
+
+    run_paths = []
+    key_width = 0
+    try:
+        with open(accession2taxid_dump, 'r') as dump:
+            run = []
+            for line in dump:
+                fields = line.split('\t')
+                if fields[0] == 'accession':
+                    continue
+                (version, taxid) = fields[1:3]
+                key_width = max(key_width, len(version))
+                run.append((version, int(taxid)))
+                if len(run) == run_size:
+                    run_paths.append(_write_sorted_run(run, index_prefix, len(run_paths)))
+                    run = []
+            if run or not run_paths:
+                run_paths.append(_write_sorted_run(run, index_prefix, len(run_paths)))
+            del run
+
+        runs = [open(path, 'rb') for path in run_paths]
+        try:
+            tmp_keys = index_prefix + '.acc.idx.tmp'
+            tmp_taxids = index_prefix + '.acc_taxid.idx.tmp'
+            with open(tmp_keys, 'wb') as keys_file:
+                with open(tmp_taxids, 'wb') as taxids_file:
+                    keys_file.write(struct.pack('<I', key_width))
+                    taxids = array('I')
+                    for line in heapq.merge(*runs):
+                        (version, taxid) = line.split('\t')
+                        keys_file.write(version.ljust(key_width, '\0'))
+                        taxids.append(int(taxid))
+                        if len(taxids) == 65536:
+                            _write_uints(taxids_file, taxids)
+                            taxids = array('I')
+                    _write_uints(taxids_file, taxids)
+        finally:
+            for run in runs:
+                run.close()
+        # rename only complete files so that a partially written
+        # index is never picked up
+        os.rename(tmp_taxids, index_prefix + '.acc_taxid.idx')
+        os.rename(tmp_keys, index_prefix + '.acc.idx')
+    finally:
+        for path in run_paths:
+            os.remove(path)
+    return index_prefix
+
+def _write_sorted_run(run, index_prefix, run_number, line_format='%s\t%d\n'):
+    run.sort()
+    path = '%s.run%d.tmp' % (index_prefix, run_number)
+    with open(path, 'wb') as run_file:
+        for (key, taxid) in run:
+            run_file.write(line_format % (key, taxid))
+    return path
+
+def _write_uints(output_file, values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    values.tofile(output_file)
+
+class Accession2TaxidIndex(object):
+    '''
+    Accession.version to tax ID mapping backed by the memory-mapped
+    index built by buildAccession2TaxidIndex. Works the same way as
+    Gi2TaxidIndex: first key of each block of block_size keys is kept
+    in memory (in a single string), so a lookup reads a single block
+    from the mapped file.
+    '''
+    block_size = 256
+    _header_size = 4
+
+    def __init__(self, index_prefix):
+        self._file = open(index_prefix + '.acc.idx', 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._width = struct.unpack_from('<I', self._map, 0)[0]
+        self._len = ((len(self._map) - self._header_size) // self._width
+                     if self._width else 0)
+        self._taxids = _MappedUIntArray(index_prefix + '.acc_taxid.idx')
+        assert (self._len == len(self._taxids))
+        self._block_heads = _FixedWidthKeys(''.join(
+                                self._h_key(i) for i in
+                                xrange(0, self._len, self.block_size)),
+                                self._width)
+
+    @classmethod
+    def open_or_build(cls, accession2taxid_dump):
+        '''
+        Opens the index built from the dump file, building it first
+        if it doesn't exist or if the dump is newer than the index.
+        '''
+        dump_mtime = os.path.getmtime(accession2taxid_dump)
+        index_files = [accession2taxid_dump + suffix
+                       for suffix in ('.acc.idx', '.acc_taxid.idx')]
+        if not all(os.path.isfile(f) and os.path.getmtime(f) >= dump_mtime
+                   for f in index_files):
+            log.info('Building accession2taxid index for %s', accession2taxid_dump)
+            buildAccession2TaxidIndex(accession2taxid_dump)
+        return cls(accession2taxid_dump)
+
+    def __len__(self):
+        return self._len
+
+    def get(self, version, default=None):
+        return self.get_taxids([version]).get(version, default)
+
+    def get_taxids(self, versions):
+        '''
+        Looks up a whole batch of accession.versions at once (in sorted
+        order, so versions falling into the same block share a single
+        read of that block).
+
+        :param versions iterable of accession.versions (str)
+        :rtype dict(key=version:str, value=taxid:int), versions not present
+        in the index are not contained in the dict
+        '''
+        version2taxid = {}
+        width = self._width
+        current_block = None
+        for version in sorted(set(versions)):
+            if len(version) > width:
+                continue
+            key = version.ljust(width, '\0')
+            block = bisect_right(self._block_heads, key) - 1
+            if block < 0:
+                continue
+            if block != current_block:
+                current_block = block
+                start = block * self.block_size
+                stop = min(start + self.block_size, self._len)
+                data = self._map[self._header_size + start * width:
+                                 self._header_size + stop * width]
+                block_keys = _FixedWidthKeys(data, width)
+            i = bisect_left(block_keys, key)
+            if i < len(block_keys) and block_keys[i] == key:
+                version2taxid[version] = self._taxids[start + i]
+        return version2taxid
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+        self._taxids.close()
+
+    def _h_key(self, i):
+        offset = self._header_size + i * self._width
+        return self._map[offset:offset + self._width]
+
+def loadNcbiNames(names_dump, name_class='scientific name', use_cache=True):
+    r'''
     Loads scientific names from NCBI names taxonomy dump.
+    Each line of the dump has the following format:
+    tax_id\t|\tname_txt\t|\tunique name\t|\tname class\t|
+    Name class field has to match exactly (common name doesn't
+    match genbank common name lines).
+
+    >>> import tempfile
+    >>> dump = tempfile.NamedTemporaryFile(suffix='.dmp')
+    >>> dump.write('10090\t|\thouse mouse\t|\t\t|\tgenbank common name\t|\n'
+    ...            '10090\t|\tmouse\t|\t\t|\tcommon name\t|\n')
+    >>> dump.flush()
+    >>> loadNcbiNames(dump.name, 'common name', use_cache=False)
+    {10090: 'mouse'}
+    >>> loadNcbiNames(dump.name, 'genbank common name', use_cache=False)
+    {10090: 'house mouse'}
 
     :param names_dump path to names dump file
+    :param name_class which name class to load (scientific name,
+    common name, genbank common name, synonym ...)
+    :param use_cache (boolean) if True, parsed table is cached next to
+    the dump file and reused while the dump doesn't change
     :rtype dict(key=taxid:int, value=organims_name:str)
     '''
-    pass
+    if not os.path.isfile(names_dump):
+        raise ValueError('''Path you supplied to the names\
+             dump file seems to be invalid.''')
+
+    def parse():
+        taxid2name = {}
+        # whole name class field, including the preceding delimiter
+        line_end = '%s%s\t|\n' % (_dmp_delimiter, name_class)
+        with open(names_dump, 'r') as names_file:
+            for line in names_file:
+                if not line.endswith(line_end):
+                    continue
+                (taxid, name) = line.split(_dmp_delimiter, 2)[0:2]
+                taxid2name[int(taxid)] = name
+        return taxid2name
 
-def loadNcbiRanks(nodes_dump):
+    if not use_cache:
+        return parse()
+    return _load_cached(names_dump, name_class, parse)
+
+def loadNcbiRanks(nodes_dump, use_cache=True):
     '''
     Loads taxonomy rank from NCBI nodes dump
+    Each line of the dump has the following format:
+    tax_id\t|\tparent tax_id\t|\trank\t|\t ... \t|
 
     :param nodes_dump path to nodes dump file
+    :param use_cache (boolean) if True, parsed table is cached next to
+    the dump file and reused while the dump doesn't change
     :rtype dict(key=taxid:int, value=taxonomy_rank:str)
     '''
-    pass
+    if not os.path.isfile(nodes_dump):
+        raise ValueError('''Path you supplied to the nodes\
+             dump file seems to be invalid.''')
+
+    def parse():
+        taxid2rank = {}
+        ranks = {}
+        with open(nodes_dump, 'r') as nodes_file:
+            for line in nodes_file:
+                (taxid, parent_taxid, rank) = line.split(_dmp_delimiter, 3)[0:3]
+                # share a single string object for each of the ranks
+                taxid2rank[int(taxid)] = ranks.setdefault(rank, rank)
+        return taxid2rank
+
+    if not use_cache:
+        return parse()
+    return _load_cached(nodes_dump, 'rank', parse)
+
+# stored with the dump signature, bumped whenever the parsing of any of
+# the tables changes, so that tables parsed by older versions are reparsed
+# (2: names of a name class no longer include those of its suffix classes)
+_cache_format = 2
+
+# tables loaded by _load_cached in this process,
+# key=(dump_path, table_name), value=(dump signature, table)
+_loaded_tables = {}
+
+def _load_cached(dump_path, table_name, parse):
+    '''
+    Loads the table parsed from the dump file from the cache file
+    (dump_path.table_name.cache). If the cache doesn't exist or it
+    has been created from a different version of the dump file (based on
+    file size and modification time), dump is parsed and the cache
+    is (re)created.
+    Loaded tables are also kept in memory and shared within the
+    process, so they must not be modified by the callers.
+
+    :param dump_path path to the dump file
+    :param table_name name of the table parsed from the dump file
+    :param parse function with no arguments which parses the dump file
+    :rtype table returned by the parse function
+    '''
+    cache_path = '%s.%s.cache' % (dump_path, table_name.replace(' ', '_'))
+    dump_stat = os.stat(dump_path)
+    dump_signature = (dump_stat.st_size, dump_stat.st_mtime, _cache_format)
+
+    loaded = _loaded_tables.get((dump_path, table_name))
+    if loaded is not None and loaded[0] == dump_signature:
+        return loaded[1]
+
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                signature = cPickle.load(cache_file)
+                if signature == dump_signature:
+                    table = cPickle.load(cache_file)
+                    _loaded_tables[(dump_path, table_name)] = (dump_signature, table)
+                    return table
+        except (EOFError, cPickle.UnpicklingError, ValueError):
+            log.warning('Corrupt cache file %s, parsing dump again.', cache_path)
 
+    table = parse()
+    _loaded_tables[(dump_path, table_name)] = (dump_signature, table)
+    try:
+        with open(cache_path, 'wb') as cache_file:
+            cPickle.dump(dump_signature, cache_file, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(table, cache_file, cPickle.HIGHEST_PROTOCOL)
+    except IOError:
+        log.warning('Unable to write cache file %s.', cache_path)
+    return table
 
 if __name__ == '__main__':
     
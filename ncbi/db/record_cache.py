@@ -0,0 +1,262 @@
+import cPickle
+import logging
+import sqlite3
+import threading
+import time
+
+from ncbi.db.unity import UnityRecord, UnityCDS
+
+log = logging.getLogger(__name__)
+
+class RecordCache(object):
+    '''
+    Stores UnityRecords (together with their CDSs) in a local SQLite file,
+    keyed by accession.version and feature table (cds, rrna, mrna, misc_rna).
+    Total size of the stored records is bounded; when the limit is
+    exceeded, least recently used records are evicted.
+    Cache remembers the snapshot tag of the database it has been filled
+    from. If the cache is opened with a different snapshot tag (reference
+    database has been updated), all the stored records are dropped.
+    '''
+
+    # version of the stored record format, records stored in
+    # a different format are dropped when the cache is opened
+    # (3: strand of complemented compound locations, 4: feature_table)
+    format_version = '4'
+
+    def __init__(self, cache_path, snapshot_tag, max_size=1024*1024*1024):
+        '''
+        :param cache_path (str) path to the cache file (created if missing)
+        :param snapshot_tag (str) tag identifying the database state
+        :param max_size (int) maximum total size of stored records in bytes
+        '''
+        self.cache_path = cache_path
+        self.snapshot_tag = str(snapshot_tag)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # records are fetched and stored from multiple threads
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.text_factory = str
+        self._h_create_schema()
+        self._h_check_snapshot()
+        self._size = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM records').fetchone()[0]
+
+    def get(self, version, table='cds'):
+        '''
+        :returns: UnityRecord or None if the record is not cached
+        '''
+        return self.get_many([version], table).get(version)
+
+    def get_many(self, versions, table='cds'):
+        '''
+        Fetches all the cached records for the given versions and
+        marks them as recently used.
+
+        :param versions list of accession.versions
+        :param table (str) feature table
+        :returns: dict(key=version:str, value=UnityRecord). Versions which
+                  are not cached are not contained in the dict.
+        '''
+        records = {}
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(versions), 500):
+                chunk = versions[i:i + 500]
+                rows = self._conn.execute(
+                    'SELECT version, data FROM records WHERE tbl=? AND version IN (%s)'
+                    % ','.join('?' * len(chunk)), [table] + chunk).fetchall()
+                for (version, data) in rows:
+                    records[version] = self._h_deserialize(data)
+                self._conn.executemany(
+                    'UPDATE records SET last_access=? WHERE tbl=? AND version=?',
+                    [(now, table, version) for (version, data) in rows])
+            self._conn.commit()
+        return records
+
+    def put(self, record, table='cds'):
+        self.put_many([record], table)
+
+    def put_many(self, records, table='cds'):
+        '''
+        Stores the records into the cache and evicts least recently
+        used records if the cache size limit has been exceeded.
+
+        :param records iterable of UnityRecords
+        :param table (str) feature table the records were fetched from
+        '''
+        now = time.time()
+        with self._lock:
+            for record in records:
+                data = self._h_serialize(record)
+                old_size = self._conn.execute(
+                    'SELECT size FROM records WHERE tbl=? AND version=?',
+                    (table, record.version)).fetchone()
+                if old_size:
+                    self._size -= old_size[0]
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                    (record.version, table, sqlite3.Binary(data), len(data), now))
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._h_evict()
+            self._conn.commit()
+
+    def clear(self):
+        ''' Removes all the records from the cache. '''
+        with self._lock:
+            self._conn.execute('DELETE FROM records')
+            self._conn.commit()
+            self._size = 0
+
+    def close(self):
+        self._conn.close()
+
+    def _h_evict(self):
+        ''' Evicts least recently used records until the cache
+            size drops below the size limit. Caller holds the lock.
+        '''
+        evicted = []
+        rows = self._conn.execute(
+            'SELECT version, tbl, size FROM records ORDER BY last_access')
+        for (version, table, size) in rows:
+            if self._size <= self.max_size:
+                break
+            evicted.append((version, table))
+            self._size -= size
+        self._conn.executemany(
+            'DELETE FROM records WHERE version=? AND tbl=?', evicted)
+        log.info('Evicted %d records from record cache %s', len(evicted), self.cache_path)
+
+    def _h_create_schema(self):
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS records (
+                version TEXT NOT NULL,
+                tbl TEXT NOT NULL,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (tbl, version))''')
+        self._conn.execute('''
+            CREATE INDEX IF NOT EXISTS records_last_access
+            ON records (last_access)''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT)''')
+        self._conn.commit()
+
+    def _h_check_snapshot(self):
+        ''' Drops all the records if they have been cached from
+            a different database snapshot or in a different format.
+        '''
+        meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+        if (meta.get('snapshot') != self.snapshot_tag or
+                meta.get('format') != self.format_version):
+            if meta:
+                log.info('Database snapshot or cache format changed (%s -> %s), dropping record cache %s',
+                         meta.get('snapshot'), self.snapshot_tag, self.cache_path)
+            self._conn.execute('DELETE FROM records')
+            self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                   [('snapshot', self.snapshot_tag),
+                                    ('format', self.format_version)])
+            self._conn.commit()
+
+    def _h_serialize(self, record):
+        # CDS state contains the parsed location, so it isn't parsed again
+        return cPickle.dumps((record.version, [cds.__getstate__() for cds in record.cds]),
+                             cPickle.HIGHEST_PROTOCOL)
+
+    def _h_deserialize(self, data):
+        (version, cdss) = cPickle.loads(str(data))
+        record = UnityRecord(version)
+        for state in cdss:
+            cds = UnityCDS.__new__(UnityCDS)
+            cds.__setstate__(state)
+            record.add_cds(cds)
+        return record
+
+class MissingRecordCache(object):
+    '''
+    Remembers accession.versions with no record in the database
+    (negative cache), so they are not queried again in later runs.
+    Entries expire after ttl seconds, and all of them are dropped if
+    the cache is opened with a different database snapshot tag.
+    '''
+
+    def __init__(self, cache_path, snapshot_tag, ttl=7*24*3600):
+        '''
+        :param cache_path (str) path to the cache file (created if missing)
+        :param snapshot_tag (str) tag identifying the database state
+        :param ttl (float) time (in seconds) after which missing versions
+                   are queried again
+        '''
+        self.cache_path = cache_path
+        self.snapshot_tag = str(snapshot_tag)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS missing (
+                version TEXT NOT NULL,
+                tbl TEXT NOT NULL,
+                checked REAL NOT NULL,
+                PRIMARY KEY (tbl, version))''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT)''')
+        self._h_check_snapshot()
+        self._conn.execute('DELETE FROM missing WHERE checked < ?',
+                           (time.time() - self.ttl,))
+        self._conn.commit()
+
+    def get_missing(self, versions, table='cds'):
+        '''
+        :param versions list of accession.versions
+        :param table (str) feature table
+        :returns: set of versions known to have no record
+        '''
+        missing = set()
+        expiry = time.time() - self.ttl
+        with self._lock:
+            for i in range(0, len(versions), 500):
+                chunk = versions[i:i + 500]
+                rows = self._conn.execute(
+                    'SELECT version FROM missing WHERE tbl=? AND checked>=? AND version IN (%s)'
+                    % ','.join('?' * len(chunk)), [table, expiry] + chunk)
+                missing.update(version for (version,) in rows)
+        return missing
+
+    def put_many(self, versions, table='cds'):
+        ''' Marks the versions as missing. '''
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO missing VALUES (?, ?, ?)',
+                [(version, table, now) for version in versions])
+            self._conn.commit()
+
+    def clear(self):
+        ''' Removes all the entries from the cache. '''
+        with self._lock:
+            self._conn.execute('DELETE FROM missing')
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def _h_check_snapshot(self):
+        ''' Drops all the entries if they have been recorded for
+            a different database snapshot.
+        '''
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key='snapshot'").fetchone()
+        if row is None or row[0] != self.snapshot_tag:
+            if row is not None:
+                log.info('Database snapshot changed (%s -> %s), dropping missing record cache %s',
+                         row[0], self.snapshot_tag, self.cache_path)
+            self._conn.execute('DELETE FROM missing')
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('snapshot', ?)",
+                               (self.snapshot_tag,))
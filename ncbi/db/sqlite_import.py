@@ -0,0 +1,256 @@
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+sys.path.append(os.getcwd())
+
+from sqlalchemy.engine import create_engine
+from sqlalchemy.sql.expression import select, table as sql_table, column as sql_column
+
+from ncbi.db.access import DbQuery, unity_feature_tables
+from ncbi.db.ncbitax_from_file import _dmp_delimiter
+
+log = logging.getLogger(__name__)
+
+# number of rows read from the source and inserted at once
+_batch_size = 10000
+
+_unity_schema = '''
+    CREATE TABLE IF NOT EXISTS %s (
+        id INTEGER PRIMARY KEY,
+        db TEXT,
+        version TEXT,
+        nucl_gi INTEGER,
+        taxon INTEGER,
+        location TEXT,
+        protein_id TEXT,
+        locus_tag TEXT,
+        product TEXT,
+        gene TEXT,
+        prot_gi INTEGER
+    )'''
+_unity_columns = ('id', 'db', 'version', 'nucl_gi', 'taxon', 'location',
+                  'protein_id', 'locus_tag', 'product', 'gene', 'prot_gi')
+
+_ncbitax_schema = {
+    'gi_taxid_nuc': '''
+        CREATE TABLE IF NOT EXISTS gi_taxid_nuc (
+            gi INTEGER PRIMARY KEY,
+            tax_id INTEGER
+        )''',
+    'ncbi_names': '''
+        CREATE TABLE IF NOT EXISTS ncbi_names (
+            tax_id INTEGER,
+            name_txt TEXT,
+            unique_name TEXT,
+            name_class TEXT
+        )''',
+    'ncbi_nodes': '''
+        CREATE TABLE IF NOT EXISTS ncbi_nodes (
+            tax_id INTEGER PRIMARY KEY,
+            parent_tax_id INTEGER,
+            rank TEXT
+        )''',
+}
+_ncbitax_columns = {
+    'gi_taxid_nuc': ('gi', 'tax_id'),
+    'ncbi_names': ('tax_id', 'name_txt', 'unique_name', 'name_class'),
+    'ncbi_nodes': ('tax_id', 'parent_tax_id', 'rank'),
+}
+# column source tables are paged by (see _h_iter_rows)
+_ncbitax_keys = {
+    'gi_taxid_nuc': 'gi',
+    'ncbi_names': 'tax_id',
+    'ncbi_nodes': 'tax_id',
+}
+_ncbitax_indexes = [
+    'CREATE INDEX IF NOT EXISTS ncbi_names_tax_id ON ncbi_names (tax_id, name_class)',
+    'CREATE INDEX IF NOT EXISTS ncbi_names_name_txt ON ncbi_names (name_txt, name_class)',
+]
+
+def import_unity(source_db_url, sqlite_path, tables=DbQuery.supported_tables):
+    '''
+    Copies unity feature tables (cds, rrna, mrna, misc_rna) from
+    the source database into the SQLite file and indexes them by
+    accession.version.
+
+    :param source_db_url (str) SQLAlchemy URL of the unity database
+    :param sqlite_path (str) path to the SQLite file (created if missing)
+    :param tables list of feature tables to copy
+    '''
+    source = create_engine(source_db_url)
+    conn = _h_connect(sqlite_path)
+    try:
+        for table in tables:
+            log.info('Importing unity table %s', table)
+            conn.execute('DROP TABLE IF EXISTS %s' % table)
+            conn.execute(_unity_schema % table)
+            feature_table = unity_feature_tables[table]
+            rows = _h_iter_rows(source, feature_table, feature_table.c.id)
+            _h_insert_rows(conn, table, _unity_columns,
+                           (tuple(r[c] for c in _unity_columns) for r in rows))
+            conn.execute('CREATE INDEX %s_version ON %s (version)' % (table, table))
+            conn.commit()
+    finally:
+        conn.close()
+
+def import_ncbitax(source_db_url, sqlite_path):
+    '''
+    Copies gi_taxid_nuc, ncbi_names and ncbi_nodes tables from the
+    source ncbitax database into the SQLite file and indexes them.
+
+    :param source_db_url (str) SQLAlchemy URL of the ncbitax database
+    :param sqlite_path (str) path to the SQLite file (created if missing)
+    '''
+    source = create_engine(source_db_url)
+    conn = _h_connect(sqlite_path)
+    try:
+        for (table, columns) in _ncbitax_columns.items():
+            log.info('Importing ncbitax table %s', table)
+            conn.execute('DROP TABLE IF EXISTS %s' % table)
+            conn.execute(_ncbitax_schema[table])
+            source_table = sql_table(table, *[sql_column(c) for c in columns])
+            rows = _h_iter_rows(source, source_table,
+                                source_table.c[_ncbitax_keys[table]])
+            _h_insert_rows(conn, table, columns, (tuple(r) for r in rows))
+            conn.commit()
+        _h_create_ncbitax_indexes(conn)
+    finally:
+        conn.close()
+
+def import_ncbitax_from_dumps(sqlite_path, gi2taxid_dump, names_dump, nodes_dump):
+    '''
+    Builds gi_taxid_nuc, ncbi_names and ncbi_nodes tables from NCBI
+    taxonomy dump files (ftp://ftp.ncbi.nih.gov/pub/taxonomy).
+
+    :param sqlite_path (str) path to the SQLite file (created if missing)
+    :param gi2taxid_dump path to gi_taxid_nucl dump file
+    :param names_dump path to names dump file
+    :param nodes_dump path to nodes dump file
+    '''
+    def gi2taxid_rows():
+        with open(gi2taxid_dump) as dump:
+            for line in dump:
+                (gi, taxid) = line.split()
+                yield (int(gi), int(taxid))
+
+    def names_rows():
+        with open(names_dump) as dump:
+            for line in dump:
+                (taxid, name, unique_name, name_class) = line.split(_dmp_delimiter)[0:4]
+                yield (int(taxid), name.decode('utf-8', 'replace'),
+                       unique_name.decode('utf-8', 'replace'),
+                       name_class.rstrip('\t|\n'))
+
+    def nodes_rows():
+        with open(nodes_dump) as dump:
+            for line in dump:
+                (taxid, parent_taxid, rank) = line.split(_dmp_delimiter)[0:3]
+                yield (int(taxid), int(parent_taxid), rank)
+
+    conn = _h_connect(sqlite_path)
+    try:
+        for (table, rows) in (('gi_taxid_nuc', gi2taxid_rows()),
+                              ('ncbi_names', names_rows()),
+                              ('ncbi_nodes', nodes_rows())):
+            log.info('Importing ncbitax table %s', table)
+            conn.execute('DROP TABLE IF EXISTS %s' % table)
+            conn.execute(_ncbitax_schema[table])
+            _h_insert_rows(conn, table, _ncbitax_columns[table], rows)
+            conn.commit()
+        _h_create_ncbitax_indexes(conn)
+    finally:
+        conn.close()
+
+def _h_connect(sqlite_path):
+    conn = sqlite3.connect(sqlite_path)
+    # database is rebuilt from scratch on failure anyway
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    return conn
+
+def _h_iter_rows(source, source_table, key):
+    '''
+    Reads all the rows of the source table in pages of _batch_size rows
+    ordered by the key column, so that the whole table is never buffered
+    on the client (MySQLdb fetches complete result sets).
+    Key doesn't have to be unique: rows sharing the last key of a page
+    are read again with the next page.
+    '''
+    last_key = None
+    while True:
+        query = select([source_table]).order_by(key).limit(_batch_size)
+        if last_key is not None:
+            query = query.where(key > last_key)
+        rows = source.execute(query).fetchall()
+        if len(rows) < _batch_size:
+            for row in rows:
+                yield row
+            return
+        page_last_key = rows[-1][key]
+        complete_rows = [row for row in rows if row[key] != page_last_key]
+        if not complete_rows:
+            # a single key fills the whole page
+            complete_rows = source.execute(select([source_table]).where(
+                                           key == page_last_key)).fetchall()
+        for row in complete_rows:
+            yield row
+        last_key = complete_rows[-1][key]
+
+def _h_insert_rows(conn, table, columns, rows):
+    query = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join(columns), ', '.join('?' * len(columns)))
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == _batch_size:
+            conn.executemany(query, batch)
+            batch = []
+    if batch:
+        conn.executemany(query, batch)
+
+def _h_create_ncbitax_indexes(conn):
+    for index in _ncbitax_indexes:
+        conn.execute(index)
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''\
+        Builds indexed SQLite files which can be used instead of the
+        unity and ncbitax MySQL databases (pass sqlite:///path/to/file
+        as --cds-db-connection and --ncbitax-db-connection).''')
+    parser.add_argument('--unity-source',
+        help='Unity database connection string to import from')
+    parser.add_argument('--unity-sqlite',
+        help='Unity SQLite output file')
+    parser.add_argument('--ncbitax-source',
+        help='NCBI Taxonomy database connection string to import from')
+    parser.add_argument('--ncbitax-sqlite',
+        help='NCBI Taxonomy SQLite output file')
+    parser.add_argument('--gi2taxid',
+        help='NCBI Taxonomy gi2taxid dump file (instead of --ncbitax-source)')
+    parser.add_argument('--nodes',
+        help='NCBI Taxonomy nodes dump (instead of --ncbitax-source)')
+    parser.add_argument('--names',
+        help='NCBI Taxonomy names dump (instead of --ncbitax-source)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.unity_sqlite:
+        if not args.unity_source:
+            parser.error('--unity-source is required for --unity-sqlite')
+        import_unity(args.unity_source, args.unity_sqlite)
+    if args.ncbitax_sqlite:
+        if args.ncbitax_source:
+            import_ncbitax(args.ncbitax_source, args.ncbitax_sqlite)
+        elif args.gi2taxid and args.names and args.nodes:
+            import_ncbitax_from_dumps(args.ncbitax_sqlite,
+                                      args.gi2taxid, args.names, args.nodes)
+        else:
+            parser.error('--ncbitax-sqlite requires either --ncbitax-source or '
+                         'all of --gi2taxid, --names and --nodes')
+
+if __name__ == '__main__':
+    main()
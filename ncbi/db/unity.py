@@ -5,11 +5,11 @@ Created on May 27, 2013
 @author: marin
 '''
 import sys
-from utils.location import Location
+from utils.location import Location, LoactionParsingException
 
-standard_fields =[
+standard_fields = (
     'id',
-    'db'
+    'db',
     'version',
     'nucl_gi',
     'taxon',
@@ -19,32 +19,148 @@ standard_fields =[
     'product',
     'gene',
     'prot_gi',
-    'cds'
-]
+)
 
 class UnityRecord(object):
     def __init__(self, version):
         self.version = version
         self.cds = []
-    
+
     def add_cds(self, cds):
         self.cds.append(cds)
 
+    def get_taxid(self):
+        '''
+        Returns tax ID of the record (taxon of its first feature which
+        has one), or None if no feature has a taxon.
+        '''
+        for cds in self.cds:
+            if cds.taxon is not None:
+                return int(cds.taxon)
+        return None
+
 class UnityCDS(object):
+    '''
+    Feature (CDS, rRNA...) row of the unity database.
+    Location string is parsed only once, when the CDS is created, into
+    start, end, strand (-1 for complemented locations, 1 otherwise) and
+    sub_intervals (tuple of (start, end) pairs of compound locations,
+    empty for simple ones). If the location can't be parsed, start
+    and end are None.
+    feature_table is the unity table the feature has been fetched from,
+    which tells apart features of records fetched from several tables.
+    CDSs are hashed and compared by identity (they are used as keys in
+    CdsAlnContainer.cds_repository and Organism.identified_coding_regions).
+
+    >>> cds = UnityCDS({'location': 'complement(join(1..5,10..20))'})
+    >>> (cds.start, cds.end, cds.strand, cds.sub_intervals)
+    (1, 20, -1, ((1, 5), (10, 20)))
+    >>> cds.get_location().complement
+    True
+    '''
+
+    __slots__ = standard_fields + ('feature_table', 'origin', 'location_min',
+                                   'start', 'end', 'strand', 'sub_intervals',
+                                   '_hydrated')
+
     def __init__(self, attributes={}):
-        self.attributes = attributes
+        self.id = attributes.get('id')
+        self.db = attributes.get('db')
+        self.version = attributes.get('version')
+        self.nucl_gi = attributes.get('nucl_gi')
+        self.taxon = attributes.get('taxon')
+        self.location = attributes.get('location')
+        self.protein_id = attributes.get('protein_id')
+        self.locus_tag = attributes.get('locus_tag')
+        self.product = attributes.get('product')
+        self.gene = attributes.get('gene')
+        self.prot_gi = attributes.get('prot_gi')
+        # cds, rrna, mrna or misc_rna (None if unknown)
+        self.feature_table = attributes.get('feature_table')
         self.origin = None
-        self.record_id = self.version #Added because of compatibility with older code
-        if self.location:
+        # lightweight rows (see DbQuery.get_records) have no descriptive fields
+        self._hydrated = attributes.has_key('protein_id')
+        self._h_parse_location()
+
+    @property
+    def record_id(self):
+        ''' Same as version, kept for compatibility with older code '''
+        return self.version
+
+    @property
+    def attributes(self):
+        ''' dict of all the database fields of this CDS '''
+        return dict((name, getattr(self, name)) for name in standard_fields)
+
+    def get_location(self):
+        '''
+        Returns Location built from the pre-parsed coordinates.
+        Sublocation references and the compound operator are not
+        preserved (use Location.from_location_str(cds.location) if needed).
+
+        :raises LoactionParsingException: if the location couldn't be parsed
+        '''
+        if self.start is None:
+            return Location.from_location_str(self.location)
+        location = Location()
+        location.start = self.start
+        location.end = self.end
+        location.strand = self.strand
+        if self.sub_intervals:
+            location.operator = 'join'
+            for (start, end) in self.sub_intervals:
+                sublocation = Location()
+                sublocation.start = start
+                sublocation.end = end
+                sublocation.strand = self.strand
+                location.sublocations.append(sublocation)
+        return location
+
+    def is_hydrated(self):
+        '''
+        Returns False if the CDS has been fetched in lightweight mode
+        (see DbQuery.get_records) and its descriptive fields
+        (protein_id, product, gene...) have not been fetched yet.
+        '''
+        return self._hydrated
+
+    def hydrate(self, attributes):
+        ''' Sets the descriptive fields fetched after a lightweight fetch. '''
+        for (name, value) in attributes.items():
+            if name in standard_fields:
+                setattr(self, name, value)
+        self._hydrated = True
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for (name, value) in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def _h_parse_location(self):
+        self.start = self.end = None
+        self.strand = 1
+        self.sub_intervals = ()
+        if not self.location:
+            self.location_min = sys.maxint
+            return
+        try:
+            location = Location.from_location_str(self.location)
+        except (LoactionParsingException, ValueError):
             self.location_min = Location.fast_min_str(self.location)
+            return
+        self.start = location.start
+        self.end = location.end
+        # complement(join(...)) leaves the outer strand unset, only
+        # its sublocations are complemented
+        if location.complement or (location.sublocations and
+                all(l.strand == -1 for l in location.sublocations)):
+            self.strand = -1
         else:
-            self.location_min = sys.maxint
-        
-    def __getattr__(self, name):
-        if self.attributes.has_key(name):
-            return self.attributes[name]
-        elif name in standard_fields:
-            return None
+            self.strand = 1
+        if location.sublocations:
+            self.sub_intervals = tuple((l.start, l.end) for l in location.sublocations)
+            self.location_min = min(start for (start, end) in self.sub_intervals)
         else:
-            raise AttributeError("'%s' object has no attribute '%s'",
-                self.__class__.__name__, name)
+            self.location_min = location.start
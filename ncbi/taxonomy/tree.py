@@ -1,9 +1,11 @@
 from  collections       import defaultdict
+from  itertools         import chain
+from  array             import array
 import os,sys
 sys.path.append(os.getcwd())
 from utils.progressbar import print_progress
 
-class TaxTree ():
+class TaxTree (object):
     ''' Loads the NCBI taxonomy tree, creates both
         parent-child and child-parent relations,
         enables parent-child relationship testing and
@@ -17,14 +19,15 @@ class TaxTree ():
             :param parent2child_fname location of the ncbi taxonomy tree file
             :param tax_nodes_fname location of the file containing taxid,
             organism name and organism rank for each taxid in the tree.
+            Taxonomy data is loaded on first access to nodes, so runs
+            that only need parent-child relations never load it.
         '''
 
         if not parent2child_fname:
             parent2child_fname = self._h_find_taxnode_file('parent2child')
         self.load(parent2child_fname)
-        if not tax_nodes_fname:
-            tax_nodes_fname = self._h_find_taxnode_file('taxdata')
-        self.load_taxonomy_data(tax_nodes_fname)
+        self.tax_nodes_fname = tax_nodes_fname
+        self._nodes = None
 
         #--------- RELEVANT TAXONOMY ASSIGNMENTS ----------#
         self._h_set_relevant_taxonomy_assignments()
@@ -42,9 +45,7 @@ class TaxTree ():
         After invoking this method, there is nodes parameter
         of type dict(key=tax_id:int, value=node:TaxNode)
         '''
-        self.nodes = {}
-        total = len(self.parent_nodes)
-        current = 0
+        self._nodes = {}
         tax_nodes_file = open(tax_nodes_fname, 'r')
         readline = tax_nodes_file.readline
         while (True):
@@ -52,9 +53,21 @@ class TaxTree ():
             if not line: break
             (taxid, org_name, rank) = line.strip().split('|')
             node = TaxNode(org_name, rank)
-            self.nodes[int(taxid)] = node
+            self._nodes[int(taxid)] = node
         tax_nodes_file.close()
 
+    @property
+    def nodes(self):
+        '''
+        Tax ID to TaxNode mapping, dict(key=tax_id:int, value=node:TaxNode).
+        Loaded from the taxonomy data file on first access.
+        '''
+        if self._nodes is None:
+            if not self.tax_nodes_fname:
+                self.tax_nodes_fname = self._h_find_taxnode_file('taxdata')
+            self.load_taxonomy_data(self.tax_nodes_fname)
+        return self._nodes
+
     def is_child (self, child_taxid, parent_taxid):
         ''' Test if child_taxid is child node of parent_taxid
             Node is not the child of itself
@@ -113,9 +126,75 @@ class TaxTree ():
             current_taxids = parent_nodes
 
 
+    def map_descendants_to_targets (self, target_taxids, include_targets=False):
+        ''' Preprocesses a set of target tax IDs for bulk descendancy
+            testing. Every node descending from any of the targets is
+            mapped to the closest (lowest) target it descends from.
+            The result should be computed once per run and passed to
+            descend_from_targets and find_target_ancestors.
+
+            :param target_taxids list or set of target tax IDs
+            :param include_targets (boolean) if True, targets are mapped
+            to themselves as well (node is not the child of itself by
+            default, same as in is_child)
+            :rtype dict(key=tax_id:int, value=target_tax_id:int)
+        '''
+        descendant2target = {}
+        # deeper targets are processed last, so they override the
+        # ancestor targets for their own descendants
+        targets = sorted(set(target_taxids),
+                         key=lambda tax_id: len(list(self.get_lineage(tax_id)))
+                                            if self.parent_nodes.has_key(tax_id) else 0)
+        for target_taxid in targets:
+            for child in self._h_list_all_children(target_taxid):
+                descendant2target[child] = target_taxid
+        if include_targets:
+            for target_taxid in targets:
+                descendant2target[target_taxid] = target_taxid
+        return descendant2target
+
+    def descend_from_targets (self, taxids, descendant2target):
+        ''' Tests for each of the tax IDs whether it descends from
+            any of the preprocessed targets.
+
+            :param taxids iterable of tax IDs
+            :param descendant2target dict returned by map_descendants_to_targets
+            :rtype list of booleans (mask), one for each tax ID
+        '''
+        return map(descendant2target.__contains__, taxids)
+
+    def find_target_ancestors (self, taxids, descendant2target):
+        ''' Finds the closest target each of the tax IDs descends from.
+
+            :param taxids iterable of tax IDs
+            :param descendant2target dict returned by map_descendants_to_targets
+            :rtype list of target tax IDs (None where tax ID doesn't descend
+            from any of the targets), one for each tax ID
+        '''
+        return map(descendant2target.get, taxids)
+
     def get_relevant_taxid (self, tax_id):
         return self.tax2relevantTax.get(tax_id, -1)
 
+    def prune (self, taxids, load_taxonomy_data=True):
+        ''' Builds a taxonomy subtree containing only the supplied
+            tax IDs (typically those seen in the read container and the
+            target organisms), relevant taxonomy assignments (potential
+            hosts and microbes) and all of their ancestors.
+            Tax IDs not present in the tree are ignored.
+
+            :param taxids iterable of tax IDs
+            :param load_taxonomy_data (boolean) if True, names and ranks
+            of the kept nodes are copied to the subtree
+            :rtype PrunedTaxTree
+        '''
+        kept = set([self.root])
+        for tax_id in chain(taxids, self.potential_hosts, self.microbes):
+            while tax_id not in kept and self.parent_nodes.has_key(tax_id):
+                kept.add(tax_id)
+                tax_id = self.parent_nodes[tax_id]
+        return PrunedTaxTree(self, kept, load_taxonomy_data)
+
     def get_lineage(self,tax_id):
         lineage = []
         while (True):
@@ -214,30 +293,37 @@ class TaxTree ():
 
 
     def _h_map_taxids_to_relevant_tax_nodes(self):
-        host_nodes = list(self.potential_hosts)
-        microbe_nodes = list(self.microbes)
-
-        self.tax2relevantTax = {}
-        for microbe_node in self.microbes:
-            microbe_children = self._h_list_all_children(microbe_node)
-            for child in microbe_children:
-                self.tax2relevantTax[child] = microbe_node
-
-        for host_node in self.potential_hosts:
-            host_children = self._h_list_all_children(host_node)
-            for child in host_children:
-                self.tax2relevantTax[child] = host_node
-
-        tagged_nodes    = self.tax2relevantTax.keys()
-        all_nodes       = self.parent_nodes.keys()
-        untagged_nodes  = set(all_nodes).difference(tagged_nodes)
-        for node in untagged_nodes:
-            self.tax2relevantTax[node] = -1
+        ''' Maps every tax ID in the tree to its relevant taxonomy
+            assignment (potential host or microbe) in a single top-down
+            traversal. Assignment node itself is not mapped to itself,
+            only its descendants are. Untagged nodes are mapped to -1.
+            If assignments are nested, potential hosts take precedence
+            over microbes, and within each of the lists the assignment
+            listed later takes precedence.
+        '''
+        priorities = {}
+        for (priority, tax_id) in enumerate(self.microbes + self.potential_hosts):
+            priorities[tax_id] = priority
+
+        self.tax2relevantTax = dict.fromkeys(self.parent_nodes, -1)
+        # (tax_id, assignment inherited from ancestors, its priority)
+        stack = [(self.root, -1, -1)]
+        while stack:
+            (tax_id, relevant_tax_id, priority) = stack.pop()
+            self.tax2relevantTax[tax_id] = relevant_tax_id
+            if priorities.get(tax_id, -1) > priority:
+                relevant_tax_id = tax_id
+                priority = priorities[tax_id]
+            for child in self.child_nodes.get(tax_id, ()):
+                if child != tax_id:
+                    stack.append((child, relevant_tax_id, priority))
 
     def _h_list_all_children(self, tax_id):
         if not self.child_nodes.has_key(tax_id):
             return []
-        one_step_children = self.child_nodes[tax_id]
+        # root is its own parent, skip it to avoid looping
+        one_step_children = [child for child in self.child_nodes[tax_id]
+                             if child != self.root]
         all_children = []
         while (True):
             if not one_step_children:
@@ -246,12 +332,121 @@ class TaxTree ():
             all_children.extend(one_step_children)
             for child in one_step_children:
                 if self.child_nodes.has_key(child):
-                    new_one_step_children.extend(self.child_nodes[child])
+                    new_one_step_children.extend(c for c in self.child_nodes[child]
+                                                 if c != self.root)
             one_step_children = new_one_step_children
         return all_children
 
 
 
+class PrunedTaxTree (object):
+    ''' Taxonomy subtree holding only the nodes relevant for a
+        single sample. Nodes are re-indexed densely so that parents
+        always precede their children, and parent relations and depths
+        are stored in flat arrays, which makes the subtree small and
+        cheap to pickle and send to worker processes.
+        Provides the same querying methods as TaxTree, using tax IDs.
+    '''
+
+    def __init__ (self, tax_tree, kept_taxids, load_taxonomy_data=True):
+        '''
+        :param tax_tree TaxTree object the subtree is pruned from
+        :param kept_taxids set of tax IDs to keep. Must be closed under
+        the parent relation (see TaxTree.prune).
+        :param load_taxonomy_data (boolean) if True, TaxNode objects
+        (names and ranks) are copied from the tax_tree
+        '''
+        self.root = tax_tree.root
+        self.potential_hosts = list(tax_tree.potential_hosts)
+        self.microbes = list(tax_tree.microbes)
+
+        depth = {self.root: 0}
+        for tax_id in kept_taxids:
+            path = []
+            while tax_id not in depth:
+                path.append(tax_id)
+                tax_id = tax_tree.parent_nodes[tax_id]
+            for node in reversed(path):
+                depth[node] = depth[tax_id] + 1
+                tax_id = node
+
+        self.taxids = sorted(kept_taxids, key=depth.__getitem__)
+        self.index = dict((tax_id, i) for (i, tax_id) in enumerate(self.taxids))
+        self.parents = array('i', (self.index[tax_tree.parent_nodes[tax_id]]
+                                   for tax_id in self.taxids))
+        self.depths = array('i', (depth[tax_id] for tax_id in self.taxids))
+
+        self.tax2relevantTax = dict((tax_id, tax_tree.tax2relevantTax.get(tax_id, -1))
+                                    for tax_id in self.taxids)
+        if load_taxonomy_data:
+            tax_nodes = tax_tree.nodes
+            self.nodes = dict((tax_id, tax_nodes[tax_id])
+                              for tax_id in self.taxids if tax_id in tax_nodes)
+        else:
+            self.nodes = {}
+
+    def is_child (self, child_taxid, parent_taxid):
+        ''' Test if child_taxid is child node of parent_taxid
+            Node is not the child of itself
+        '''
+        if child_taxid == parent_taxid:
+            return False
+        if parent_taxid == self.root:
+            return True
+        if child_taxid not in self.index or parent_taxid not in self.index:
+            return False
+        child = self.index[child_taxid]
+        parent = self.index[parent_taxid]
+        parents = self.parents
+        # climb up to the depth of the parent node
+        for i in xrange(self.depths[child] - self.depths[parent]):
+            child = parents[child]
+        return child == parent
+
+    def find_lca (self, taxid_list):
+        ''' Finds the lowest common ancestor of
+            a list of nodes
+        '''
+        for taxid in taxid_list:
+            if taxid not in self.index:
+                raise Exception ("Key error, no element with id %d." % taxid)
+
+        parents = self.parents
+        depths = self.depths
+        lca = self.index[taxid_list[0]]
+        for taxid in taxid_list[1:]:
+            node = self.index[taxid]
+            while depths[node] > depths[lca]:
+                node = parents[node]
+            while depths[lca] > depths[node]:
+                lca = parents[lca]
+            while node != lca:
+                node = parents[node]
+                lca = parents[lca]
+        return self.taxids[lca]
+
+    def get_relevant_taxid (self, tax_id):
+        return self.tax2relevantTax.get(tax_id, -1)
+
+    def get_lineage (self, tax_id):
+        lineage = []
+        node = self.index[tax_id]
+        while node != 0:
+            lineage.append(self.taxids[node])
+            node = self.parents[node]
+        return reversed(lineage)
+
+    def get_parent_with_rank (self, tax_id, rank):
+        node = self.index[tax_id]
+        while node != 0:
+            tax_id = self.taxids[node]
+            if self.nodes[tax_id].rank == rank:
+                return tax_id
+            node = self.parents[node]
+        return 0
+
+
+
 class TaxNode (object):
     '''
     Taxonomy nodes hold information on relevant
@@ -11,7 +11,7 @@ from utils.argparser import DefaultBinnerArgParser
 from ncbi.db.data_access import DataAccess
 from ncbi.taxonomy.tree import TaxTree
 from data.containers.read import ReadContainer
-from data.containers.record import RecordContainer
+from data.containers.record import RecordContainer, RecordPrefetcher
 from data.containers.cdsaln import CdsAlnContainer
 import filters.host as host_filter
 import filters.readprocessing as rstate
@@ -75,9 +75,15 @@ def main():
     #------- ALIGNMENT DATA SOURCE ----#
     print '2. Loading alignment file...'
     read_container = ReadContainer()
-    read_container.load_alignment_data(args.input)
+    record_prefetcher = None
+    if args.prefetch_records or args.taxids_from_records:
+        record_prefetcher = RecordPrefetcher(dataAccess, table='cds', lightweight=True)
+    read_container.load_alignment_data(args.input, record_prefetcher)
     #---SET TAXIDS FOR ALL ALIGNMENTS--#
-    read_container.set_taxids(dataAccess)
+    if args.taxids_from_records:
+        read_container.set_taxids(dataAccess, record_prefetcher)
+    else:
+        read_container.set_taxids(dataAccess)
     print 'done'
 
     #------- FILTER HOST READS -------#
@@ -93,7 +99,6 @@ def main():
         #unassigned_taxid=
         -1,
         host_filter.perc_of_host_alignments_larger_than)
-    dataAccess.clear_cache()    # deletes gi2taxid cache
     reads_with_no_host_alignments = host_filter.filter_potential_hosts_alignments(
         new_reads,
         tax_tree.tax2relevantTax,
@@ -103,19 +108,21 @@ def main():
         -1)     # unassigned taxid
     host_read_count = len(read_container.fetch_all_reads(format=list)) - len(reads_with_no_host_alignments)
     read_container.set_new_reads(reads_with_no_host_alignments)
+    if record_prefetcher is not None:
+        # records referenced only by host reads are not needed
+        record_prefetcher.retain(read_container.fetch_all_reads_versions())
     print 'done'
 
     #----------------------------------#
     #------- LOAD ALL RECORDS   -------#
-    print '4. Loading referenced records...'
-    record_container = RecordContainer()
-    record_container.set_db_access(dataAccess)
-    record_container.populate(read_container.fetch_all_reads_versions(), table='cds')
-    print 'done'
-    #----------------------------------#
     #-- MAP ALIGNMENTS TO GENES   -----#
-    print '5. Mapping alignments to genes...'
-    read_container.populate_cdss(record_container)
+    print '4-5. Loading referenced records & mapping alignments to genes...'
+    record_container = RecordContainer()
+    record_container.set_db_access(record_prefetcher or dataAccess)
+    # alignments of each record are mapped while the rest are fetched
+    # (prefetched records are served from memory, no need for threads)
+    read_container.populate_cdss_while_fetching(record_container, table='cds',
+        num_threads=1 if record_prefetcher is not None else 4, lightweight=True)
     #----------------------------------#
     #- RECORD ALL ALIGNEMENTS TO GENE -#
     cds_aln_container = CdsAlnContainer()
@@ -152,6 +159,10 @@ def main():
     print 'done.'
 
     print '9. Generating XML...'
+    # records were loaded in lightweight mode, fetch gene descriptions
+    # only for the genes which are reported
+    dataAccess.hydrate_cdss([identified_cds.cds for org in orgs.values()
+                             for identified_cds in org.identified_coding_regions.values()])
     dataset = Dataset(args.xml_description_file)
     xml_organisms = []
     host = Organism (host_read_count, host_read_count, None, None, "Host",
@@ -163,5 +174,10 @@ def main():
     xml = XMLOutput(dataset, xml_organisms, args.output) 
     xml.xml_output();
 
+    query_summary = dataAccess.get_query_summary()
+    if query_summary:
+        print 'Database query statistics:'
+        print query_summary
+
 if __name__ == '__main__':
     main()
@@ -80,7 +80,6 @@ def main():
         #unassigned_taxid=
         -1,
         host_filter.is_best_score_host)
-    dataAccess.clear_cache()    # deletes gi2taxid cache
     reads_with_no_host_alignments = host_filter.filter_potential_hosts_alignments(
         new_reads,
         tax_tree.tax2relevantTax,
@@ -96,8 +95,9 @@ def main():
     print '4. Loading referenced records...'
     record_container = RecordContainer()
     record_container.set_db_access(dataAccess)
-    record_container.populate(read_container.fetch_all_reads_versions(), table='cds')
-    record_container.populate(read_container.fetch_all_reads_versions(), table='rrna')
+    # CDSs and rRNAs are fetched together, so mapping sees both
+    record_container.populate(read_container.fetch_all_reads_versions(),
+                              table=('cds', 'rrna'))
     print 'done'
     #----------------------------------#
     #-- MAP ALIGNMENTS TO GENES   -----#
@@ -114,6 +114,9 @@ def main():
     output_file = open(args.output, 'w')
 
     for cds_aln in cds_aln_container.fetch_all_cds_alns():
+        # CDSs are fetched only to be mapped together with the rRNAs
+        if cds_aln.cds.feature_table != 'rrna':
+            continue
         output = cds_aln.cds.version + ','
         location = Location.from_location_str(cds_aln.cds.location)
         if location.start is not None:
@@ -136,6 +139,10 @@ def main():
 
     output_file.close()
 
+    query_summary = dataAccess.get_query_summary()
+    if query_summary:
+        print 'Database query statistics:'
+        print query_summary
 
 
 if __name__ == '__main__':
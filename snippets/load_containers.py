@@ -96,7 +96,6 @@ def main():
         #unassigned_taxid=
         -1,
         host_filter.perc_of_host_alignments_larger_than)
-    dataAccess.clear_cache()    # deletes gi2taxid cache
     reads_with_no_host_alignments = host_filter.filter_potential_hosts_alignments(
         new_reads,
         tax_tree.tax2relevantTax,
@@ -110,22 +109,25 @@ def main():
 
     #----------------------------------#
     #------- LOAD ALL RECORDS   -------#
-    print '4. Loading referenced records...'
+    #-- MAP ALIGNMENTS TO GENES   -----#
+    print '4-5. Loading referenced records & mapping alignments to genes...'
     record_container = RecordContainer()
     record_container.set_db_access(dataAccess)
-    record_container.populate(read_container.fetch_all_reads_versions(), table='cds')
-    record_container.populate(read_container.fetch_all_reads_versions(), table='rrna')
-    print 'done'
-    #----------------------------------#
-    #-- MAP ALIGNMENTS TO GENES   -----#
-    print '5. Mapping alignments to genes...'
-    read_container.populate_cdss(record_container)
+    # CDSs and rRNAs are fetched together, so mapping sees both;
+    # alignments of each record are mapped while the rest are fetched
+    read_container.populate_cdss_while_fetching(record_container,
+                                                table=('cds', 'rrna'))
     #----------------------------------#
     #- RECORD ALL ALIGNEMENTS TO GENE -#
     cds_aln_container = CdsAlnContainer()
     cds_aln_container.populate(read_container.fetch_all_reads(format=list))
     print 'done'
 
+    query_summary = dataAccess.get_query_summary()
+    if query_summary:
+        print 'Database query statistics:'
+        print query_summary
+
     #import pickle
     #read_file = open(args.read_file, 'w')
     #record_file = open(args.record_file, 'w')
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''
+    Size-bounded key-value cache. When the cache is full, storing
+    a new key evicts the least recently used one.
+    Keeps track of hit, miss and eviction counts.
+    '''
+
+    def __init__(self, max_size):
+        '''
+        :param max_size (int) maximum number of cached entries
+        '''
+        assert (max_size > 0)
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        '''
+        Returns the cached value and marks it as recently used.
+        Returns default if the key is not cached.
+        '''
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            del self._entries[key]
+        elif len(self._entries) >= self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        self._entries[key] = value
+
+    def clear(self):
+        ''' Removes all the entries (statistics are kept). '''
+        self._entries.clear()
+
+    def stats(self):
+        '''
+        :rtype dict with size, max_size, hits, misses and evictions
+        '''
+        return {'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries